@@ -0,0 +1,244 @@
+#!/usr/bin/python3
+
+# Step generation benchmarks for JWBCamPIGPIO, run in-process against the simulated pigpio backend
+#
+#   python3 JWBCamBench.py [-o /tmp/JWBCamBench.json] [--latency 0.0002] [--quick]
+#
+# Measures wavelet build rate and Python time per pulse, the highest step rate the engine sustains
+# at every Microstep setting, move start latency and GPIO requests with and without the stored move
+# script, and command latency while a move is running. Results are written as
+# JSON so runs of different versions can be compared. The benchmark serves its own socket, BENCH_SOCKET,
+# and never maps the shared memory status block, so it can run alongside the daemon. Both drive the
+# same pins though, so only run it next to a daemon backed by real pigpio when that is harmless.
+
+import os
+os.environ['JWBCAM_PIGPIO'] = 'sim'
+import argparse
+import json
+import platform
+import socket
+import tempfile
+from collections import OrderedDict
+from threading import Thread
+from time import time, sleep, strftime
+import numpy as np
+import JWBCamPIGPIO as daemon
+import pigpiosim
+import jwbstepper as client
+
+BENCH_SOCKET = '\0JWBCamBench.sock'
+
+def summarize(samples):
+	# Latency percentiles in microseconds
+	us = np.array(samples)*1000000
+	return OrderedDict([('count', len(us)),
+						('mean_us', round(float(us.mean()), 1)),
+						('p50_us', round(float(np.percentile(us, 50)), 1)),
+						('p95_us', round(float(np.percentile(us, 95)), 1)),
+						('p99_us', round(float(np.percentile(us, 99)), 1)),
+						('max_us', round(float(us.max()), 1))])
+
+def startDaemon(latency):
+	daemon.startPigpio()
+	daemon.pi.callLatency = latency
+	daemon.servesock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	daemon.servesock.bind(BENCH_SOCKET)
+	client.socketName = BENCH_SOCKET
+	daemon.servesock.listen(2)
+	controller = Thread(target=daemon.stepperControl)
+	controller.start()
+	Thread(target=daemon.serveClients, daemon=True).start()
+	daemon.parseMessage('enable')
+	return controller
+
+def stopDaemon(controller):
+	daemon.stopFlag = True
+	daemon.running = False
+	daemon.moveRequests.put(None)
+	controller.join()
+	daemon.stopPigpio()
+	daemon.servesock.close()
+
+def waitIdle():
+	while daemon.stepperState > 1 or daemon.moveRequests.qsize():
+		sleep(0.001)
+
+def benchWavelets(seconds):
+	# Wavelet build rate with pigpiod latency removed, so the time is the Python cost of building
+	latency = daemon.pi.callLatency
+	daemon.pi.callLatency = 0
+	stepMask = 1<<daemon.stepperPins['Step']
+	stepOn = pigpiosim.pulse(stepMask,0,5)
+	results = OrderedDict()
+	for size in (10, 100, 1000):
+		profile = daemon.planRamp(200000)
+		wavelets = pulses = ii = 0
+		start = time()
+		while time() - start < seconds:
+			delays = daemon.waveletDelays(profile, ii, size)
+			daemon.wavePool.delete(daemon.createWave(delays, stepOn, stepMask))
+			wavelets += 1
+			pulses += size
+			ii = (ii + size) % (len(profile) - size)
+		elapsed = time() - start
+		results[str(size)] = OrderedDict([('wavelets_per_sec', round(wavelets/elapsed, 1)),
+										  ('pulses_per_sec', round(pulses/elapsed, 1)),
+										  ('python_us_per_pulse', round(elapsed/pulses*1000000, 3))])
+	start = time()
+	for ii in range(20):
+		daemon.invalidateRamps()
+		daemon.planRamp(20000)
+	results['planRamp_20000_ms'] = round((time() - start)/20*1000, 3)
+	daemon.pi.callLatency = latency
+	return results
+
+def plannable(rate):
+	# Cruise at rate steps/sec from now on, False if the planner refuses the ramps it needs. Set without
+	# the Velocity command as the engine is measured past the Velocity bound
+	return daemon.changeSettings({'Velocity':rate*daemon.stepAngle()})
+
+def sustains(rate, cruise):
+	# Run a move cruising at rate steps/sec for about cruise seconds, True if it kept to plan
+	plannable(rate)
+	plan = daemon.planRamp(float('inf'))
+	steps = int(len(plan) + plan.decelSteps + rate*cruise)
+	planned = daemon.planRamp(steps).micros()/1000000
+	gaps = daemon.pi.idleGaps
+	start = time()
+	daemon.parseMessage('step' + str(steps))
+	sleep(0.01)
+	waitIdle()
+	elapsed = time() - start
+	underruns = daemon.pi.idleGaps - gaps - 1 # the first wave of every move starts from idle
+	return underruns <= 0 and elapsed <= planned*1.02 + 0.05, elapsed, planned
+
+def sustained(rate, cruise, attempts=2):
+	# A rate passes if any attempt keeps to plan, so one scheduling hiccup doesn't end the search
+	return any(sustains(rate, cruise)[0] for ii in range(attempts))
+
+def benchMaxRate(cruise, ceiling):
+	# Highest sustained step rate per Microstep, doubling then bisecting on the step rate
+	results = OrderedDict()
+	velocityBound = daemon.fullSettingsList['Velocity'][3][1]
+	saved = (daemon.settings.Microstep, daemon.settings.Velocity, daemon.settings.Acceleration, daemon.settings.Deceleration)
+	daemon.parseMessage('Acceleration500')
+	daemon.parseMessage('Deceleration-500')
+	for microstep in sorted(daemon.ustepStateMults):
+		daemon.stepSize(microstep)
+		good, bad = 0, None
+		rate = 1000
+		while bad is None and rate <= ceiling and plannable(rate):
+			if sustained(rate, cruise):
+				good, rate = rate, rate*2
+			else:
+				bad = rate
+		while bad is not None and bad - good > max(good/20, 100):
+			rate = (good + bad)//2
+			if sustained(rate, cruise):
+				good = rate
+			else:
+				bad = rate
+		velocityLimit = velocityBound/daemon.stepAngle()
+		results[str(microstep)] = OrderedDict([('engine_steps_per_sec', good),
+											   ('engine_limited', bad is not None),
+											   ('velocity_bound_steps_per_sec', round(velocityLimit)),
+											   ('max_steps_per_sec', min(good, round(velocityLimit))),
+											   ('max_rad_per_sec', round(min(good, velocityLimit)*daemon.stepAngle(), 3))])
+	daemon.stepSize(saved[0])
+	daemon.parseMessage('Velocity' + str(saved[1]))
+	daemon.parseMessage('Acceleration' + str(saved[2]))
+	daemon.parseMessage('Deceleration' + str(saved[3]))
+	return results
+
+def benchMoveStart(count):
+	# Time from the start of a move to its first wavelet and GPIO requests per move, with the stored
+	# move script and with plain writes, plus GPIO requests per Microstep change
+	gpioCalls = ('write', 'set_bank_1', 'clear_bank_1', 'run_script')
+	calls = lambda: sum(daemon.pi.callCounts.get(name, 0) for name in gpioCalls)
+	script = daemon.moveScript
+	autoDisable = daemon.settings.Auto_Disable
+	daemon.settings.Auto_Disable = True # every move starts from a disabled driver
+	results = OrderedDict()
+	for mode in ('script', 'writes'):
+		if mode == 'script' and script is None:
+			continue
+		daemon.moveScript = script if mode == 'script' else None
+		daemon.timings['moveLatency'] = daemon.TimingRing(daemon.timeEdges)
+		before = calls()
+		for ii in range(count):
+			daemon.parseMessage('step' + ('-2' if ii % 2 else '2'))
+			while daemon.stepperState != 0: # until auto disabled after the move
+				sleep(0.001)
+		results[mode] = OrderedDict([('move_latency', daemon.timings['moveLatency'].summary()),
+									 ('gpio_requests_per_move', (calls() - before)/count)])
+		del results[mode]['move_latency']['histogram']
+	daemon.moveScript = script
+	daemon.settings.Auto_Disable = autoDisable
+	microstep = daemon.settings.Microstep
+	before = calls()
+	for ii in range(count):
+		daemon.stepSize(sorted(daemon.ustepStateMults)[ii % len(daemon.ustepStateMults)])
+	results['gpio_requests_per_microstep_change'] = (calls() - before)/count
+	daemon.stepSize(microstep)
+	return results
+
+def benchLatency(count):
+	# Command latency idle and while a move runs, both in-process and over the socket
+	connection = client.Connection() # a bare connection, jwbstepper would answer getstate from shared memory
+	commands = ('getstate', 'Stepper_Position', 'Velocity', 'settings')
+	results = OrderedDict()
+	for phase in ('idle', 'moving'):
+		if phase == 'moving':
+			daemon.parseMessage('run60')
+			while daemon.stepperState != 3:
+				sleep(0.001)
+		dispatch = OrderedDict()
+		for command in commands:
+			samples = []
+			for ii in range(count):
+				start = time()
+				daemon.parseMessage(command)
+				samples.append(time() - start)
+			dispatch[command] = summarize(samples)
+		samples = []
+		for ii in range(count):
+			start = time()
+			connection.command('getstate')
+			samples.append(time() - start)
+		results[phase] = OrderedDict([('parseMessage', dispatch), ('socket_round_trip', summarize(samples))])
+	daemon.parseMessage('stop')
+	waitIdle()
+	connection.close()
+	return results
+
+def main():
+	parser = argparse.ArgumentParser(description='JWBCamPIGPIO step generation benchmarks')
+	parser.add_argument('-o', '--output', default=os.path.join(tempfile.gettempdir(), 'JWBCamBench.json'), help='JSON results file')
+	parser.add_argument('--latency', type=float, default=0.0002, help='simulated pigpiod call latency in seconds')
+	parser.add_argument('--quick', action='store_true', help='shorter runs for a rough result')
+	args = parser.parse_args()
+	controller = startDaemon(args.latency)
+	results = OrderedDict([('version', daemon.settings.Version),
+						   ('timestamp', strftime('%Y-%m-%dT%H:%M:%S')),
+						   ('python', platform.python_version()),
+						   ('machine', platform.machine()),
+						   ('call_latency_s', args.latency),
+						   ('wave_queue_depth', daemon.waveQueueDepth)])
+	try:
+		print('Wavelet build rate')
+		results['wavelets'] = benchWavelets(0.5 if args.quick else 2)
+		print('Maximum step rate per Microstep')
+		results['max_step_rate'] = benchMaxRate(0.1 if args.quick else 0.3, 64000 if args.quick else 256000)
+		print('Move start latency')
+		results['move_start'] = benchMoveStart(20 if args.quick else 200)
+		print('Command latency')
+		results['command_latency'] = benchLatency(100 if args.quick else 1000)
+		results['pigpiod_calls'] = daemon.pi.callCounts
+	finally:
+		stopDaemon(controller)
+	with open(args.output, 'w') as f:
+		json.dump(results, f, indent=2)
+	print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+	main()
@@ -205,11 +205,9 @@ def steppercom(command=None):
 			elif command == 'runUp':
 				stepper.stopAndWait()
 				stepper.runfor(stepperlocals['runLimit'])
-			elif command == 'stepUp':
-				stepper.stopAndWait()
+			elif command == 'stepUp': # queued behind, or blended into, any move in progress
 				stepper.move(stepperlocals['stepSize'])
 			elif command == 'stepDown':
-				stepper.stopAndWait()
 				stepper.move(-stepperlocals['stepSize'])
 			elif command == 'runDown':
 				stepper.stopAndWait()
@@ -258,6 +256,19 @@ def steppercom(command=None):
 		else:
 			return redirect(url_for('stepperroot'))
 
+@app.route('/stepper/estop', methods=['GET','POST'])
+def stepperestop():
+	# Emergency stop - skips the lock and admin checks of steppercom, replies with the daemon's stop report
+	global stepper
+	if not 'username' in session:
+		return redirect(url_for('index'))
+	try:
+		report = stepper.estop()
+	except ConnectionError:
+		logging.warning('No Stepper Connected')
+		return Response(json.dumps({'stopped':False}),status=503,mimetype='application/json')
+	return Response(json.dumps(report),mimetype='application/json')
+
 @app.route('/camera/')
 def cameraroot():
 	global cameralocals, camera
@@ -486,13 +497,16 @@ def stepper_stream():
 
 def stepperStream():
 	global stepper
-	vals = stepper.settingsVals()
-	while stepper.is_connected():
-		sleep(0.2)
-		newVals = stepper.settingsVals()
-		if newVals != vals:
-			vals = newVals
-			yield 'data: ' + json.dumps(vals) + '\n\n'
+	try:
+		subscription = stepper.subscribe(interval=0.2)
+	except ConnectionError:
+		logging.warning('No Stepper Connected')
+		return
+	try:
+		for changes in subscription:
+			yield 'data: ' + json.dumps(changes) + '\n\n'
+	finally:
+		subscription.close()
 
 @app.route('/JWBCam/status/')
 def status_updates():
@@ -6,15 +6,15 @@
 import logging
 import gphoto2 as gp
 import json
-import mmap
 from threading import Thread, Event
 from collections import OrderedDict
 from usb.core import find as finddev
 from io import BytesIO as BIO
-from time import sleep
+from time import sleep, time
 from weakref import WeakSet
 from sys import byteorder as BO
 import pyudev
+from jwbprotocol import FrameRing
 
 # GPhoto2Error - gphoto2 error class
 global MV
@@ -75,8 +75,7 @@ class ModuleVariables():
 		self.previewInterval = 0.1
 		self.capturing = False
 		self.lastImage = None
-		self.fname = None
-		self.mmjpg = None
+		self.frames = None
 		
 		self.imageClients = WeakSet()
 		self.settingsClients = WeakSet()
@@ -267,11 +266,7 @@ def updatePreview():
 	MV.capturing = False
 	try:
 		while MV.previewing and MV.ready:
-			lastImage = BIO(cap.get_data_and_size()).getvalue()
-			MV.mmjpg.seek(0)
-			howMany = MV.mmjpg.write(lastImage)
-			for client in MV.imageClients:
-				client.sendall(MV.fname.encode('utf-8') + '&' + str(howMany).encode('utf-8'))
+			publishImage(BIO(cap.get_data_and_size()).getvalue())
 			sleep(MV.previewInterval)
 			while len(MV.imageClients) == 0 and MV.previewing and MV.ready:
 				sleep(MV.previewInterval)
@@ -295,6 +290,18 @@ def updatePreview():
 		MV.previewing = False
 		purge_events()
 
+def publishImage(lastImage):
+	# Store the image in the next frame ring slot and tell image clients 'path&sequence&length'.
+	# Clients read it with FrameRing.read(sequence) while it is still in the ring
+	global MV
+	try:
+		seq = MV.frames.write(lastImage, time())
+	except ValueError as e:
+		logging.error(e)
+		return
+	for client in MV.imageClients:
+		client.sendall((MV.frames.path + '&' + str(seq) + '&' + str(len(lastImage))).encode('utf-8'))
+
 def registerImageClient(newClient):
 	global MV
 	if not newClient in MV.imageClients:
@@ -343,11 +350,7 @@ def captureImage():
 				MV.previewing = False
 				purge_events()
 	MV.capturing = False
-	lastImage = BIO(cap.get_data_and_size()).getvalue()
-	MV.mmjpg.seek(0)
-	howMany = MV.mmjpg.write(lastImage)
-	for client in MV.imageClients:
-		client.sendall(MV.fname.encode('utf-8') + '&' + str(howMany).encode('utf-8'))
+	publishImage(BIO(cap.get_data_and_size()).getvalue())
 
 def isReady():
 	global MV
@@ -485,13 +488,7 @@ if __name__ == '__main__':
 			kwargs['client'] = client
 		return func(**kwargs)
 	
-	if not os.path.exists('./JWBCamImage.jpg'):
-		with open('./JWBCamImage.jpg','w+') as f:
-			f.write('\00' * 1024*1024*20) # Write 20 MB of null values to the file to init
-			f.flush()
-	fimg = open('./JWBCamImage.jpg','r+b')
-	MV.fname = os.path.realpath(fimg.name)
-	MV.mmjpg = mmap.mmap(fimg.fileno(),0)
+	MV.frames = FrameRing(create=True)
 	
 	# Unlink / bind unix socket and listen for incoming connections
 	# if os.path.exists('/var/tmp/JWBCamGpPi.pe'):
@@ -6,13 +6,23 @@
 
 import logging
 import signal
-import pigpio
+import os
+import sys
+if '--simulate' in sys.argv or os.environ.get('JWBCAM_PIGPIO') == 'sim':
+	import pigpiosim as pigpio # hardware free runs - see pigpiosim.py
+else:
+	import pigpio
 import socket
-from collections import OrderedDict
+from collections import OrderedDict, deque
 import json
 import math
-from select import select
-from threading import Thread, Event
+import numpy as np
+from jwbprotocol import FrameReader, ProtocolError, isFramed, packReply, packFrame, encodeLegacy, decodePayload
+from jwbprotocol import FRAME_TEXT, FRAME_ERROR, FRAME_EVENT, FRAME_WATCH, SOCKET_NAME
+from jwbprotocol import stepperStates, StatusBlock, STATUS_ENABLED, STATUS_TARGET
+import selectors
+from queue import Queue
+from threading import Thread, Condition, Lock, Timer
 from time import time, sleep
 from sys import exit as EXIT
 
@@ -46,61 +56,365 @@ class Settings():
 	def list(self):
 		return self._attrs
 
-global running, stopFlag, pi, stepperState, stepperAwake, settings, movedir, stepsToTake
+class WavePool():
+	# Owns the pigpio wave resources used by stepperControl. Every wave is padded to an equal
+	# share of the DMA control blocks and pulses so a deleted wave's ID and space can be
+	# reused while another wave is transmitting, without resorting to wave_clear
+	def __init__(self, pi, slots, timing=None):
+		self.pi = pi
+		self.slots = slots
+		self.timing = timing # TimingRing for pigpiod call latency
+		self.percent = 100 // slots
+		self.maxPulses = pi.wave_get_max_pulses()
+		self.maxCbs = pi.wave_get_max_cbs()
+		self.slotPulses = self.maxPulses * self.percent // 100
+		self.slotCbs = self.maxCbs * self.percent // 100
+		self.maxSteps = min((self.slotPulses - 8) // 2, (self.slotCbs - 16) // 4) # 2 pulses and up to 4 CBs per step,
+		# leaving room for trigger edges merged into a wavelet
+		self.live = OrderedDict() # wave ID : pulse count, oldest first
+		self.seen = set()
+		self.created = 0
+		self.deleted = 0
+		self.reused = 0
+		self.failures = 0
+		self.clears = 0
+		self.peak = 0
+		pi.wave_clear()
+	
+	def create(self, wave, extra=None):
+		# extra pulses are interleaved in time with wave by pigpiod
+		start = time()
+		self.pi.wave_add_generic(wave)
+		if extra:
+			self.pi.wave_add_generic(extra)
+		middle = time()
+		try:
+			wid = self.pi.wave_create_and_pad(self.percent)
+		except pigpio.error:
+			self.failures += 1
+			self.pi.wave_add_new() # drop the pulses of the failed wave, leave existing waves alone
+			raise
+		if self.timing:
+			self.timing.add((middle - start)*1000000)
+			self.timing.add((time() - middle)*1000000)
+		if wid in self.seen:
+			self.reused += 1
+		self.seen.add(wid)
+		self.live[wid] = len(wave)
+		self.created += 1
+		self.peak = max(self.peak, len(self.live))
+		return wid
+	
+	def delete(self, wid):
+		if self.live.pop(wid, None) is None:
+			return
+		self.deleted += 1
+		start = time()
+		self.pi.wave_delete(wid)
+		if self.timing:
+			self.timing.add((time() - start)*1000000)
+	
+	def clear(self):
+		self.pi.wave_clear()
+		self.live.clear()
+		self.clears += 1
+	
+	def stats(self):
+		return OrderedDict((('slots', self.slots),
+							('live', len(self.live)),
+							('peak', self.peak),
+							('pulses', sum(self.live.values())),
+							('maxPulses', self.maxPulses),
+							('cbs', len(self.live) * self.slotCbs),
+							('maxCbs', self.maxCbs),
+							('maxStepsPerWave', self.maxSteps),
+							('created', self.created),
+							('deleted', self.deleted),
+							('reused', self.reused),
+							('failures', self.failures),
+							('clears', self.clears)))
+
+class TriggerSchedule():
+	# Shutter and focus pulses of one move, merged into its wavelets as extra pulses so they are timed by
+	# the same DMA stream as the steps. Times are microseconds of move time from the first step pulse.
+	# A trigger fires at a step of the move ('step') or a delay after its last step period ends ('after')
+	def __init__(self, triggers):
+		self.steps = sorted((t for t in triggers if t['step'] is not None), key=lambda t: t['step'])
+		self.after = [t for t in triggers if t['step'] is None]
+		self.mask = 0
+		for trigger in triggers:
+			self.mask |= trigger['mask']
+		self.edges = [] # (move time, on mask, off mask) not yet built into a wavelet
+		self.built = 0 # move time at the start of the next wavelet
+		self.marks = {} # first step of each unsent wavelet : schedule state before it was built
+		self.fired = [] # (pin, step, move time) of each trigger pulse built into a wavelet
+	
+	def wavelet(self, first, delays):
+		# Extra pulses for the wavelet of steps from first with the given delays, None if there are none
+		self.marks[first] = (list(self.steps), list(self.edges), self.built, len(self.fired))
+		while self.steps and self.steps[0]['step'] < first + len(delays):
+			trigger = self.steps.pop(0)
+			k = max(trigger['step'] - first, 0)
+			self.schedule(trigger, self.built + sum(delays[:k]) + 5*k)
+		micros = sum(delays) + 5*len(delays)
+		pulses = self.pulses(self.built + micros)
+		self.built += micros
+		return pulses
+	
+	def tail(self):
+		# Pulses for everything left once the last step has been built, timed from its end
+		for trigger in self.after:
+			self.schedule(trigger, self.built + trigger['after'])
+		self.after = []
+		return self.pulses(infinity)
+	
+	def schedule(self, trigger, at):
+		self.edges.append((at, trigger['mask'], 0))
+		self.edges.append((at + trigger['width'], 0, trigger['mask']))
+		self.fired.append((trigger['pin'], trigger['step'], at))
+	
+	def pulses(self, end):
+		# Take the edges before move time end as pulses timed from the start of the wavelet being built
+		due = sorted(edge for edge in self.edges if edge[0] < end)
+		if not due:
+			return None
+		self.edges = [edge for edge in self.edges if edge[0] >= end]
+		pulses = [pigpio.pulse(0, 0, int(due[0][0] - self.built))] if due[0][0] > self.built else []
+		for ii, (at, on, off) in enumerate(due):
+			following = due[ii+1][0] if ii + 1 < len(due) else at
+			pulses.append(pigpio.pulse(on, off, int(following - at)))
+		return pulses
+	
+	def sent(self, first):
+		self.marks.pop(first, None)
+	
+	def rewind(self, first):
+		# Undo the wavelets from step first onwards after they were discarded
+		if first not in self.marks:
+			return
+		self.steps, self.edges, self.built, fired = self.marks[first]
+		del self.fired[fired:]
+		for key in [key for key in self.marks if key >= first]:
+			del self.marks[key]
+
+class Scan():
+	# Continuous scan - one move at a constant velocity through frames evenly spaced positions from
+	# start to end, run up from far enough back to be at speed by the first. Each frame fires as the
+	# step reaching its position is taken, on the trigger pin if one is wired and as a frame event.
+	# Raises ValueError for an invalid spec
+	def __init__(self, spec, position):
+		global settings, fullSettingsList, stepperPins, triggerPins, triggerWidth, maxScanFrames, maxMoveSteps, maxPulseDelay
+		frames = int(spec['frames'])
+		end = int(spec['end'])
+		velocity = float(spec.get('velocity', settings.Velocity))
+		if not 2 <= frames <= maxScanFrames or not 0 < velocity <= fullSettingsList['Velocity'][3][1]:
+			raise ValueError('frames or velocity out of range')
+		ramp = planRamp(infinity, velocity)
+		lead = ramp.accelFinished + 2 # steps from the origin to the first frame, all but the last accelerating
+		if 'start' in spec:
+			start = int(spec['start'])
+			direction = 1 if end > start else -1
+		else:
+			direction = 1 if end > position else -1
+			start = position + direction*lead
+		if (end - start)*direction <= 0:
+			raise ValueError('end within the run-up')
+		spacing = abs(end - start)//(frames - 1)
+		if spacing < 2:
+			raise ValueError('frames closer than 2 steps')
+		origin = start - direction*lead
+		while 0 < abs(position - origin) < 2: # too close for a move to the origin, run up further
+			origin -= direction
+		if abs(end - origin) + ramp.decelSteps > maxMoveSteps:
+			raise ValueError('scan too long')
+		self.velocity = velocity
+		self.direction = direction
+		self.origin = origin
+		self.positions = [start + round(k*(end - start)/(frames - 1)) for k in range(frames)]
+		self.steps = [abs(p - origin) - 1 for p in self.positions] # step of the scan move reaching each frame
+		self.moveSteps = abs(end - origin) + ramp.decelSteps
+		self.pin = spec.get('pin', 'Shutter' if stepperPins['Shutter'] else None)
+		period = stepAngle()*1000000/velocity
+		self.width = int(spec.get('width', min(triggerWidth, spacing*period/2)))
+		if self.width <= 0 or self.width >= spacing*period or self.width > maxPulseDelay:
+			raise ValueError('trigger width longer than the frame spacing')
+		self.triggers = []
+		if self.pin is not None:
+			if self.pin not in triggerPins or not stepperPins[self.pin]:
+				raise ValueError('trigger pin not wired')
+			mask = 1<<stepperPins[self.pin]
+			for step in self.steps:
+				self.triggers.append(OrderedDict((('pin', self.pin), ('mask', mask), ('step', step),
+												  ('after', None), ('width', self.width), ('now', False))))
+		self.next = 0 # first frame not yet handed to pigpiod
+		self.timers = []
+		self.captured = []
+	
+	def sent(self, txStart, first, pulses, delays):
+		# Note the frames in a wavelet handed to pigpiod and time their events to its step timing
+		while self.next < len(self.steps) and self.steps[self.next] < first + pulses:
+			k = self.steps[self.next] - first
+			at = txStart + (sum(delays[:k]) + 5*k)/1000000
+			frame = OrderedDict((('frame', self.next), ('position', self.positions[self.next]), ('time', at)))
+			timer = Timer(max(at - time(), 0), self.fire, (frame,))
+			timer.start()
+			self.timers.append(timer)
+			self.next += 1
+	
+	def fire(self, frame):
+		self.captured.append(frame)
+		pushEvent(OrderedDict([('event', 'frame')] + list(frame.items())))
+	
+	def finish(self):
+		# Drop the events of frames that will not fire, the move was stopped
+		for timer in self.timers:
+			timer.cancel()
+		self.timers = []
+
+class TimingRing():
+	# Fixed size ring buffer of recent samples - adding is a list store, percentiles and the
+	# histogram over edges are only computed when summary() is asked for
+	def __init__(self, edges, size=2048):
+		self.edges = edges
+		self.size = size
+		self.samples = [0.0]*size
+		self.index = 0
+		self.total = 0
+	
+	def add(self, value):
+		self.samples[self.index] = value
+		self.index = (self.index + 1) % self.size
+		self.total += 1
+	
+	def summary(self):
+		values = np.array(self.samples[:min(self.total, self.size)])
+		summary = OrderedDict((('total', self.total), ('window', len(values))))
+		if len(values):
+			p50, p90, p99 = np.percentile(values, (50, 90, 99))
+			summary['mean'] = round(float(values.mean()), 1)
+			summary['p50'] = round(float(p50), 1)
+			summary['p90'] = round(float(p90), 1)
+			summary['p99'] = round(float(p99), 1)
+			summary['max'] = round(float(values.max()), 1)
+			counts = np.histogram(np.clip(values, self.edges[0], self.edges[-1]), self.edges)[0]
+			summary['histogram'] = OrderedDict((('edges', self.edges), ('counts', counts.tolist())))
+		return summary
+
+global running, stopFlag, pi, stepperState, moveRequests, settings, movedir, stepsToTake
 
 running = True
 stopFlag = False
 pi = None
 stepperState = 0
-stepperAwake = Event()
+moveRequests = Queue() # ('move', op, value, generation, waiter) or ('program', ops) for stepperControl, None to exit
+moveQueueLimit = 8 # moves accepted while one is running before replying busy
+moveGeneration = 0 # bumped by stops so moves queued before the stop are dropped
+moveWaiters = [] # (client, request ID) to notify when the move in progress ends, one per queued move it took
 settings = Settings()
 # message = ''
 movedir = 1
 dir2pin = {1:1,-1:0}
 stepsToTake = 0
 servesock = None
+selector = None
+clients = {} # socket : Client for every open command connection
+wakeReader = None # socketpair used by other threads to wake the command server
+wakeWriter = None
+statusPending = False
+moveScript = None # pigpiod stored script that enables the driver and sets direction, p0 = direction level
+enablePending = False # driver enable deferred to the start of the next move
+statusBlock = None # shared memory status for clients, see jwbprotocol.StatusBlock
+statusLock = Lock() # one writer at a time for the status block seqlock
+statusWritten = 0 # time of the last status block write
+statusHeartbeat = 1 # seconds between status block writes while nothing changes, so clients can tell the daemon is alive
+moveStart = 0 # position the active move started from
 
 settings.Stepper_Position = 0
 settings.Direction = 'CW'
 settings.Velocity = 9.42477 # Maximum Velocity in radians per second - DEFAULT = 3 RPS / 2
 settings.Acceleration = 50 # Acceleration (+) in radians per second per second
 settings.Deceleration = -100 # Deceleration (-) in radians per second per second
+settings.Profile = 'Trapezoid' # Motion profile planner - Trapezoid or S-Curve (jerk limited)
+settings.Jerk = 1000 # Rate of change of acceleration in radians per second cubed - S-Curve only
 settings.Auto_Disable = True
 settings.Microstep = 32
 settings.Screw_Lead = 8 # travel per rotation in mm
 settings.Base_Step_Angle = 0.0314159
 settings.Steps_Per_Rotation = 200
 settings.Version = '1.1.0_20180112'
-# settings.Wavelet_Length = 25000 # Time in microseconds for each PWM wavelet 
-#  - should be less than 50 ms to feel responsive
+settings.Wavelet_Min = 10000 # Shortest wavelet in microseconds - wavelet length adapts between these bounds
+settings.Wavelet_Max = 100000 # Longest wavelet in microseconds - should be less than ~100 ms to feel responsive
 
 fullSettingsList = {'Acceleration':('integer','bounded',50,(0.1,500)),
 					'Deceleration':('integer','bounded',-100,(-500,-0.1)),
 					'Velocity':('float','bounded',9.42477,(0.1,100)),
+					'Profile':('string','enumerated','Trapezoid',('Trapezoid','S-Curve')),
+					'Jerk':('float','bounded',1000,(1,100000)),
 					'Direction':('string','enumerated','CW',('CW','CCW','Toggle')),
 					'Base_Step_Angle':('float','bounded',0.0314159,(0.001,1.570795)),
 					'Screw_Lead':('float','bounded',8,(0.2,25.4)),
 					'Steps_Per_Rotation':('integer','bounded',200,(4,1200)),
 					'Stepper_Position':('integer','infinite',0,(-float('inf'),float('inf'))),
 					'Auto_Disable':('boolean','enumerated',True,(False,True)),
+					'Wavelet_Min':('integer','bounded',10000,(2000,50000)),
+					'Wavelet_Max':('integer','bounded',100000,(10000,500000)),
 					'Version':('string','constant',settings.Version,(None,None)),
 					'Microstep':('integer','list',16,(1,2,4,8,16,32))}
 
 C0 = 53584
 enabled = False
 
-lastWave = None
-waveBeforeLast = None
+wavePool = None
+readyWaves = deque() # (wave ID, first step, step count, duration us, step delays) built ahead, not yet sent
+sentWaves = deque() # (wave ID, estimated start time, estimated end time, first step, step count, step delays)
+txLock = Lock() # held to send a wavelet or change sentWaves, and by estop to halt the transmitter
+txHalts = 0 # bumped by each estop, a move stops sending once it differs from the value it started with
+waveQueueDepth = 3 # number of wavelets built ahead of transmission
+txWakeMargin = 0.002 # seconds before a slot is expected to free up to wake and check
+waveletLength = 25000 # current wavelet duration target in microseconds, adapted by adaptWavelet()
+waveletLoadHigh = 0.2 # build time / transmit time above which wavelets are lengthened
+waveletLoadLow = 0.05 # and below which they are shortened
+engineStats = OrderedDict([('wavelets',0), # wavelets built
+						   ('underruns',0), # wavelets handed to pigpiod after the previous one finished
+						   ('buildMicros',0), # total time spent building wavelets
+						   ('txMicros',0), # total transmit time of the wavelets built
+						   ('lastLoad',0), # build time / transmit time of the last full length wavelet
+						   ('peakLoad',0), # the highest lastLoad seen
+						   ('retargets',0)]) # moves ramped to settings changed while they ran
+timeEdges = [0] + [2**k for k in range(21)] # microseconds, 1 us to ~1 s
+depthEdges = list(range(18))
+timings = OrderedDict([('waveBuild', TimingRing(timeEdges)), # us to build and create one wavelet
+					   ('pigpiodCall', TimingRing(timeEdges)), # us per pigpiod call on the motion path
+					   ('waitForTx', TimingRing(timeEdges)), # us waiting for a transmit slot
+					   ('dispatch', TimingRing(timeEdges)), # us from a command arriving to its reply being queued
+					   ('moveLatency', TimingRing(timeEdges)), # us from the start of a move to its first wavelet being sent
+					   ('estop', TimingRing(timeEdges)), # us from an estop command arriving to the transmitter halting
+					   ('waveQueue', TimingRing(depthEdges)), # wavelets built ahead at each send
+					   ('moveQueue', TimingRing(depthEdges))]) # moves waiting when stepperControl takes one
 moveStartTime = 0
 moveMaxTime = 10
 infinity = float('inf')
 decelFactor = -settings.Deceleration/settings.Acceleration # precalculated dec/acc factor
-
-stepperStates = {0 : 'Disabled',
-				 1 : 'Stopped',
-				 2 : 'Accelerating',
-				 3 : 'Moving',
-				 4 : 'Decelerating'}
+rampCache = {} # step delay profiles keyed by (rampKey(), steps) - cleared by compC0()
+rampCacheSize = 4000000 # step periods held by rampCache before it is cleared, 32 MB
+rampCacheHeld = 0
+maxRampSteps = 1000000 # longest acceleration or deceleration ramp planned, settings needing more are refused
+maxMoveSteps = 2**53 # longest move accepted, positions stay exact as floats and fit the status block
+estimateCache = {} # move duration estimates keyed by (rampKey(), op, steps or seconds)
+estimateCacheSize = 1024
+programRunning = False
+moveFollows = False # the motion thread runs another move straight after this one
+programAbort = False
+programLog = [] # one entry per completed program operation
+programSignals = set() # signals raised by the signal command, consumed by wait operations
+programCondition = Condition() # notified on signals and aborts
+programOps = {'step':'steps', # op : parameter
+			  'stepTo':'position',
+			  'move':'distance',
+			  'moveTo':'position',
+			  'run':'seconds',
+			  'dwell':'seconds',
+			  'wait':'signal'}
 
 stepperPins = {'Direction'	: 15,
 			   'Step'		: 18,
@@ -109,7 +423,16 @@ stepperPins = {'Direction'	: 15,
 			   'MS3'		: 24,
 			   'MS2'		: 10,
 			   'MS1'		: 25,
-			   'Enable'		: 8}
+			   'Enable'		: 8,
+			   'Shutter'	: None, # optional camera remote lines, None when not wired
+			   'Focus'		: None}
+triggerPins = ('Shutter','Focus')
+triggerWidth = 100000 # default trigger pulse width in microseconds
+maxPulseDelay = 2**32 - 1 # longest pulse in microseconds, pigpio packs pulse delays as uint32
+armedTriggers = [] # trigger pulses for the next move to start
+scanLog = OrderedDict((('running', False), ('frames', 0), ('captured', []))) # progress of the last scan
+maxScanFrames = 10000 # most frames in one scan, each holds a trigger and a timer until the scan ends
+pendingEvents = deque() # events for every subscriber, sent by the command server
 
 ustepStatePins = {1	: (0,0,0),
 				  2	: (1,0,0),
@@ -125,32 +448,357 @@ ustepStateMults = {1	: 1,
 				   16	: 0.0625,
 				   32	: 0.03125}
 
+class RampPlan():
+	# Step periods in microseconds for a move, indexed and sliced like an array of one period per step.
+	# Only the ramps are held - head from the first step, tail to the last - the steps between them
+	# cruise at one period, so a plan is the same size however long the move. Unbounded moves
+	# (steps = inf) hold head only and cruise at its last period from there on
+	def __init__(self, head, cruise, tail, steps, accelFinished, decelStarted, decelSteps):
+		self.head = head
+		self.cruise = cruise
+		self.tail = tail
+		self.steps = steps
+		self.tailStart = steps - len(tail)
+		self.accelFinished = accelFinished
+		self.decelStarted = decelStarted
+		self.decelSteps = decelSteps
+		self.size = len(head) + len(tail)
+	
+	def __len__(self):
+		return len(self.head) if self.steps == infinity else self.steps
+	
+	def __getitem__(self, ii):
+		if isinstance(ii, slice):
+			start, stop, stride = ii.indices(len(self))
+			return np.concatenate((self.head[start:stop],
+								   np.full(max(min(stop, self.tailStart) - max(start, len(self.head)), 0), self.cruise),
+								   self.tail[max(start - self.tailStart, 0):max(stop - self.tailStart, 0)]))
+		if ii < 0:
+			ii += len(self)
+		if ii < len(self.head):
+			return self.head[ii]
+		if ii >= self.tailStart:
+			return self.tail[ii - self.tailStart]
+		return self.cruise
+	
+	def micros(self, start=0, stop=None):
+		# Time in microseconds to send steps start to stop, rounded as waveletDelays rounds, without
+		# building the cruise
+		sent = lambda delays: float((np.rint(delays - 5) + 5).sum())
+		stop = self.steps if stop is None else stop
+		cruising = max(min(stop, self.tailStart) - max(start, len(self.head)), 0)
+		return sent(self.head[start:stop]) + cruising*(float(np.rint(self.cruise - 5)) + 5) + \
+			sent(self.tail[max(start - self.tailStart, 0):max(stop - self.tailStart, 0)])
+	
+	def shortest(self):
+		periods = [part.min() for part in (self.head, self.tail) if len(part)]
+		if self.tailStart > len(self.head):
+			periods.append(self.cruise)
+		return min(periods)
+
 def compC0():
 	# 0.676*1000000*sqrt(2*baseStepAngle*ustepStateMults[ustepState]/accel))
 	global C0, ustepStateMults, settings
 	accel = settings.Acceleration
 	sAngle = settings.Base_Step_Angle
 	C0 = 676000*math.sqrt(2*sAngle*ustepStateMults[settings.Microstep]/accel)
+	invalidateRamps()
+	planRamp() # precompute the unbounded ramp used by runs and blends, raises ValueError if too long
+
+def changeSettings(values):
+	# Apply motion settings and replan, returns False with the old values restored if they need
+	# ramps longer than maxRampSteps
+	global settings
+	old = OrderedDict((name, getattr(settings, name)) for name in values)
+	for name, value in values.items():
+		setattr(settings, name, value)
+	try:
+		compC0()
+	except ValueError:
+		for name, value in old.items():
+			setattr(settings, name, value)
+		compC0()
+		return False
+	return True
+
+def rampKey():
+	global settings
+	return (settings.Velocity, settings.Acceleration, settings.Deceleration,
+			settings.Microstep, settings.Base_Step_Angle, settings.Profile, settings.Jerk)
+
+def invalidateRamps():
+	global rampCache, rampCacheHeld
+	rampCache.clear()
+	rampCacheHeld = 0
+
+def cacheRamp(key, value):
+	global rampCache, rampCacheSize, rampCacheHeld
+	if rampCacheHeld + value.size > rampCacheSize:
+		invalidateRamps()
+	rampCache[key] = value
+	rampCacheHeld += value.size
+	return value
+
+def planRamp(steps=float('inf'), velocity=None):
+	# Accel/cruise/decel step delay profile for a move, the ramps computed in one pass each.
+	# Unbounded moves (steps = inf) hold the acceleration ramp only, the last entry is the cruise delay.
+	# velocity overrides the Velocity setting as the cruise velocity. Raises ValueError if a ramp
+	# would be longer than maxRampSteps
+	global C0, settings, ustepStateMults, maxRampSteps
+	key = (rampKey(), steps, velocity)
+	plan = rampCache.get(key)
+	if plan is not None:
+		return plan
+	if velocity is None:
+		velocity = settings.Velocity
+	if settings.Profile == 'S-Curve':
+		return cacheRamp(key, planSCurve(steps, velocity))
+	sigma = 0.736*settings.Base_Step_Angle*ustepStateMults[settings.Microstep]
+	vel2 = velocity*velocity
+	accel = settings.Acceleration
+	decel = settings.Deceleration
+	accelFinished = math.floor(vel2 / (sigma*accel))
+	decelSteps = -math.floor(vel2 / (sigma*decel))
+	if steps < float('inf'):
+		decelStarted = steps - decelSteps
+		if decelStarted < accelFinished:
+			accelFinished = int(-steps*decel / (accel - decel))
+			decelStarted = steps - accelFinished
+			decelSteps = steps - decelStarted
+		last = max(min(accelFinished, steps - 1), 0) # last step of the acceleration ramp
+	else:
+		decelStarted = float('inf')
+		last = accelFinished
+	if max(last, decelSteps) > maxRampSteps:
+		raise ValueError('ramp longer than ' + str(maxRampSteps) + ' steps')
+	# C(k) = C(k-1) * factor(k), so the profile is a cumulative product of the per step factors.
+	# The factor is 1 between the ramps, every cruise step has the period of the last accelerating one
+	ka = np.arange(1, last + 1, dtype=float)
+	rise = np.cumprod(1 - 2*(accelFinished-ka) / ((4*ka+1)*accelFinished))
+	head = C0*np.concatenate(([1.0], rise))
+	tail = np.empty(0)
+	if steps < float('inf'):
+		tailStart = max(decelStarted, last + 1)
+		kd = np.arange(tailStart - steps, 0, dtype=float) # k - steps, exact however long the move
+		fall = 1 - 2*(kd + steps - decelStarted) / ((4*kd+1)*max(steps-decelStarted-1,1))
+		tail = C0*np.cumprod(np.concatenate((rise[-1:] if len(rise) else [1.0], fall)))[1:]
+	return cacheRamp(key, RampPlan(head, head[-1], tail, steps, accelFinished, decelStarted, decelSteps))
+
+def estimateMove(op, value):
+	# Duration of a step, stepTo, move, moveTo or run operation from the current position with the
+	# current settings, from the same profile runMove would send. Timed runs are estimated to within a
+	# wavelet, the stop is only noticed between wavelets
+	global estimateCache, estimateCacheSize, decelFactor
+	if op == 'run':
+		value = abs(value)
+		key = (rampKey(), op, value)
+	else:
+		value = abs(programSteps(op, value))
+		key = (rampKey(), 'step', value)
+	estimate = estimateCache.get(key)
+	if estimate is not None:
+		return estimate
+	if op == 'run':
+		ramp = planRamp(infinity)
+		micros = np.rint(ramp.head - 5) + 5 # as sent by waveletDelays
+		elapsed = np.cumsum(micros)
+		cruise = micros[-1]
+		if value*1000000 <= elapsed[-1]:
+			steps = int(np.searchsorted(elapsed, value*1000000)) + 1
+		else:
+			steps = len(micros) + int((value*1000000 - elapsed[-1])/cruise)
+		C = ramp[min(steps, len(ramp)-1)]
+		delays, stopSteps = planStop(C, int(min(steps/decelFactor, ramp.decelSteps)))
+		down = (np.rint(delays - 5) + 5).sum()
+		accel = min(elapsed[min(steps, len(micros)) - 1], value*1000000)
+		total = min(value*1000000, elapsed[-1] + (steps - len(micros))*cruise) + down
+		steps += stopSteps
+		peak = stepVelocity(C)
+	else:
+		plan = planRamp(value)
+		accelFinished = int(min(plan.accelFinished, value))
+		decelStarted = int(min(max(plan.decelStarted, accelFinished), value))
+		total = plan.micros()
+		accel = plan.micros(0, accelFinished)
+		down = plan.micros(decelStarted)
+		steps = value
+		peak = stepVelocity(plan.shortest())
+	estimate = OrderedDict((('steps', int(steps)),
+							('seconds', round(float(total)/1000000, 6)),
+							('accelSeconds', round(float(accel)/1000000, 6)),
+							('cruiseSeconds', round(float(total - accel - down)/1000000, 6)),
+							('decelSeconds', round(float(down)/1000000, 6)),
+							('peakVelocity', round(float(peak), 6))))
+	if len(estimateCache) >= estimateCacheSize:
+		estimateCache.clear()
+	estimateCache[key] = estimate
+	return estimate
+
+def planBlend(C, steps):
+	# Profile for a move extended by a blended move - the plan whose acceleration ramp passes through
+	# step period C, entered at that point with steps still to take. Returns (plan, entry index).
+	# A shorter plan ramps differently, so the entry is found on the ramp of the plan it enters
+	j = rampEntry(planRamp(float('inf')).head, C)
+	for ii in range(4): # the plan length depends on the entry, settles in a step or two
+		plan = planRamp(j + steps)
+		k = rampEntry(plan.head, C)
+		if k == j:
+			break
+		j = k
+	else:
+		plan = planRamp(j + steps)
+	return plan, j
+
+def rampEntry(ramp, C):
+	# Index of the step period closest to C on an acceleration ramp
+	j = min(int(np.searchsorted(-ramp, -C)), len(ramp)-1)
+	if j and ramp[j-1] - C < C - ramp[j]:
+		j -= 1
+	return j
+
+def planStop(C, steps):
+	# Deceleration profile from step period C to a stop, returns (delays, steps to stop).
+	# The trapezoid stops in steps steps, the S-Curve in as many as its jerk limit needs
+	global settings
+	if settings.Profile == 'S-Curve':
+		delays = sCurveRamp(0, stepVelocity(C), -settings.Deceleration, settings.Jerk)[::-1]
+		return delays, len(delays)
+	key = ('stop', steps)
+	factors = rampCache.get(key)
+	if factors is None:
+		ii = np.arange(1, steps, dtype=float)
+		factors = cacheRamp(key, np.concatenate(([1.0],
+					np.cumprod(1 - 2*ii / ((4*(ii-steps)+1)*max(steps-1,1))))))
+	return C*factors, steps
+
+def planSlowdown(C, velocity):
+	# Step periods easing from step period C down to the cruise period of velocity. Raises ValueError
+	# if that takes more than maxRampSteps
+	global settings, maxRampSteps
+	if settings.Profile == 'S-Curve':
+		return sCurveRamp(velocity, stepVelocity(C), -settings.Deceleration, settings.Jerk)[::-1]
+	sigma = 0.736*stepAngle()
+	steps = max(int(stepVelocity(C)**2 / (sigma*-settings.Deceleration)), 2)
+	if steps > maxRampSteps:
+		raise ValueError('ramp longer than ' + str(maxRampSteps) + ' steps')
+	delays, steps = planStop(C, steps)
+	period = stepAngle()*1000000/velocity if velocity > 0 else infinity # easing down to 0 is a stop
+	return delays[:max(int(np.searchsorted(delays, period)), 1)]
+
+def planRetarget(C, steps):
+	# Profile for a move retargeted to the current settings at step period C with steps still to take -
+	# up the new acceleration ramp or eased down to the new cruise. Returns (plan, entry index), or
+	# None if a bounded move has too few steps left to slow down and still stop where planned
+	global settings
+	ramp = planRamp(infinity)
+	cruise = ramp.cruise
+	if C >= cruise:
+		return planBlend(C, steps)
+	try:
+		slow = planSlowdown(C, settings.Velocity)
+	except ValueError: # the new deceleration is too gentle to plan from this speed, carry on as planned
+		return None
+	if steps == infinity:
+		return RampPlan(np.concatenate((slow, [cruise])), cruise, np.empty(0), infinity, len(slow), infinity, ramp.decelSteps), 0
+	down, stopSteps = planStop(cruise, ramp.decelSteps)
+	if steps - len(slow) - stopSteps < 0:
+		return None
+	return RampPlan(slow, cruise, down, steps, len(slow), steps - stopSteps, stopSteps), 0
+
+def stepAngle():
+	global settings, ustepStateMults
+	return settings.Base_Step_Angle*ustepStateMults[settings.Microstep]
+
+def stepVelocity(C):
+	# Angular velocity in radians per second for step period C in microseconds
+	return stepAngle()*1000000/C
+
+def sCurveTime(dv, accel, jerk):
+	# Duration of a jerk limited velocity change of dv with acceleration limited to accel
+	if dv >= accel*accel/jerk:
+		return dv/accel + accel/jerk
+	return 2*math.sqrt(dv/jerk)
+
+def sCurveRamp(v0, v1, accel, jerk):
+	# Step periods in microseconds while velocity rises from v0 to v1 with jerk limited acceleration.
+	# Entry k is the time from step k to step k+1, velocity is sampled densely and integrated to
+	# position, then step times are found by interpolation - all vectorized. Raises ValueError for a
+	# ramp longer than maxRampSteps
+	global maxRampSteps
+	dv = v1 - v0
+	if dv <= 0:
+		return np.empty(0)
+	theta = stepAngle()
+	T = sCurveTime(dv, accel, jerk)
+	peak = min(accel, jerk*T/2)
+	samples = int(min(max(8*(v0+v1)*T/(2*theta), 256), 400000))
+	t = np.linspace(0, T, samples)
+	a = np.minimum(np.minimum(jerk*t, jerk*(T-t)), peak)
+	dt = T/(samples-1)
+	v = v0 + np.concatenate(([0.0], np.cumsum((a[1:]+a[:-1])*dt/2)))
+	p = np.concatenate(([0.0], np.cumsum((v[1:]+v[:-1])*dt/2)))
+	if p[-1]/theta > maxRampSteps:
+		raise ValueError('ramp longer than ' + str(maxRampSteps) + ' steps')
+	stepTimes = np.interp(theta*np.arange(0, int(p[-1]/theta)+1), p, t)
+	return np.diff(stepTimes)*1000000
+
+def planSCurve(steps, velocity):
+	# Jerk limited profile - S shaped ramps up to velocity, lowered if the move is too short to
+	# reach it, then cruise and a mirrored S shaped ramp down
+	global settings
+	theta = stepAngle()
+	accel = settings.Acceleration
+	decel = -settings.Deceleration
+	jerk = settings.Jerk
+	vmax = velocity
+	if not vmax > 0:
+		raise ValueError('velocity must be positive')
+	rampSteps = lambda v: v*(sCurveTime(v, accel, jerk) + sCurveTime(v, decel, jerk))/(2*theta)
+	if steps < float('inf') and rampSteps(vmax) > steps:
+		low, high = 0.0, vmax
+		for ii in range(40):
+			mid = (low + high)/2
+			if rampSteps(mid) > steps:
+				high = mid
+			else:
+				low = mid
+		vmax = low
+	up = sCurveRamp(0, vmax, accel, jerk)
+	cruise = theta*1000000/vmax
+	down = sCurveRamp(0, vmax, decel, jerk)[::-1]
+	if steps == float('inf'):
+		return RampPlan(np.concatenate((up, [cruise])), cruise, np.empty(0), float('inf'), len(up), float('inf'), len(down))
+	up = up[:steps]
+	down = down[len(down)-min(len(down), steps-len(up)):]
+	return RampPlan(up, cruise, down, steps, len(up), steps - len(down), len(down))
 
 def recomp():
-	global pi
-	pi.wave_clear()
+	global wavePool
+	wavePool.clear()
 	compC0()
 
-def enable():
-	global pi, stepperPins, stepperState, enabled
-	pi.write(stepperPins['Enable'],0)
+def enable(defer=False):
+	# defer leaves the pin write to startMove, saving a pigpiod request when a move follows at once
+	global pi, stepperPins, stepperState, enabled, enablePending
+	if defer:
+		enablePending = True
+	else:
+		pi.write(stepperPins['Enable'],0)
+		enablePending = False
 	enabled = True
 	if stepperState == 0:
 		stepperState = 1
+	statusChanged()
 
 def disable():
-	global pi, stepperPins, enabled, stepperState
+	global pi, stepperPins, enabled, stepperState, enablePending
 	pi.write(stepperPins['Enable'],1)
 	enabled = False
+	enablePending = False
 	stepperState = 0
+	statusChanged()
 
-def setdir(direction='Toggle'):
+def setdir(direction='Toggle', write=True):
 	global pi, movedir, settings, dir2pin
 	val = -1
 	if direction.startswith('CW'):
@@ -171,23 +819,53 @@ def setdir(direction='Toggle'):
 			val = dir2pin[movedir]
 			settings.Direction = 'CW'
 	if val > -1:
-		pi.write(stepperPins['Direction'],val)
+		if write:
+			pi.write(stepperPins['Direction'],val)
+		statusChanged()
 		return 'success'
 	else:
 		print('Direction Set Fail: ' + direction)
 		return 'invalid'
 
+def writeBank(levels):
+	# Write several GPIO levels with at most two pigpiod requests instead of one per pin
+	global pi
+	high = 0
+	low = 0
+	for pin in levels:
+		if pin:
+			if levels[pin]:
+				high |= 1<<pin
+			else:
+				low |= 1<<pin
+	if high:
+		pi.set_bank_1(high)
+	if low:
+		pi.clear_bank_1(low)
+
+def startMove(direction):
+	# Enable the driver if deferred and set the direction - a single pigpiod request with the stored
+	# script, which has finished long before the first wavelet has been built and created
+	global pi, stepperPins, moveScript, enablePending, movedir, dir2pin
+	if moveScript is not None:
+		setdir(direction, False)
+		pi.run_script(moveScript, [dir2pin[movedir]])
+	else:
+		if enablePending:
+			pi.write(stepperPins['Enable'],0)
+		setdir(direction)
+	enablePending = False
+
 def stepSize(newState=16):
 	global pi, settings, ustepStatePins, stepperPins
 	try:
 		levels = ustepStatePins[newState]
 	except:
-		return
-	pi.write(stepperPins['MS1'],levels[0])
-	pi.write(stepperPins['MS2'],levels[1])
-	pi.write(stepperPins['MS3'],levels[2])
-	settings.Microstep = newState
-	compC0()
+		return False
+	if not changeSettings({'Microstep':newState}):
+		return False
+	writeBank({stepperPins['MS1']:levels[0], stepperPins['MS2']:levels[1], stepperPins['MS3']:levels[2]})
+	return True
 
 def dist2step(dist = 1):
 	global settings
@@ -201,8 +879,10 @@ def step2dist(steps = 1):
 	return steps * ustepStateMults[settings.Microstep] * settings.Screw_Lead / settings.Steps_Per_Rotation
 
 def startPigpio():
-	global pi, stepperPins, settings
+	global pi, stepperPins, settings, wavePool, waveQueueDepth, moveScript
 	pi = pigpio.pi()
+	wavePool = WavePool(pi, waveQueueDepth + 2, timings['pigpiodCall']) # built ahead + transmitting + queued in pigpiod
+	levels = {}
 	for pin in stepperPins:
 		if stepperPins[pin]:
 			pi.set_mode(stepperPins[pin],pigpio.OUTPUT)
@@ -210,143 +890,669 @@ def startPigpio():
 			  level = 1
 			else:
 				level = 0
-			pi.write(stepperPins[pin],level)
+			levels[stepperPins[pin]] = level
+	writeBank(levels)
 	stepSize(settings.Microstep)
+	try:
+		moveScript = pi.store_script(('w %d 0 w %d p0' % (stepperPins['Enable'], stepperPins['Direction'])).encode())
+		while pi.script_status(moveScript)[0] == pigpio.PI_SCRIPT_INITING:
+			sleep(0.001)
+	except pigpio.error as ex:
+		print('JWBCamPIGPIO move script unavailable, using writes - ' + str(ex))
+		moveScript = None
 
 def stopPigpio():
-	global pi, enabled
+	global pi, enabled, moveScript
 	if pi:
 		if enabled:
 			disable()
+		if moveScript is not None:
+			pi.delete_script(moveScript)
+			moveScript = None
 		pi.stop()
 		pi = None
 
-def stepperControl():
-	global pi, lastWave, waveBeforeLast, C0, decelFactor, stepsToTake, ustepStateMults, movedir
-	global stepperPins, stopFlag, stepperState, moveStartTime, moveMaxTime, settings, stepperAwake
-	stepPin = stepperPins['Step']
+def waveletDelays(profile, ii, pulses):
+	delays = np.rint(profile[ii:ii+pulses] - 5).astype(int).tolist()
+	if len(delays) < pulses: # unbounded run past the end of the acceleration ramp
+		delays.extend([round(profile[-1]-5)]*(pulses-len(delays)))
+	return delays
+
+def createWave(delays, stepOn, stepMask, extra=None):
+	global wavePool
+	wave = []
+	for delay in delays:
+		wave.append(stepOn)
+		wave.append(pigpio.pulse(0,stepMask,delay))
+	return wavePool.create(wave, extra)
+
+def parseTriggers(text):
+	# Trigger pulses from a json object or list of objects, None if any is invalid. Each has a pin
+	# (Shutter or Focus), an optional width in microseconds and when to fire - step (a step of the next
+	# move), after (microseconds after the next move ends) or delay (microseconds from now, once queued
+	# moves have finished)
+	global stepperPins, triggerPins, triggerWidth, maxPulseDelay
+	try:
+		specs = json.loads(text)
+	except ValueError:
+		return None
+	if isinstance(specs, dict):
+		specs = [specs]
+	if not isinstance(specs, list):
+		return None
+	triggers = []
+	for spec in specs:
+		if not isinstance(spec, dict) or spec.get('pin') not in triggerPins or not stepperPins[spec['pin']]:
+			return None
+		try:
+			width = int(spec.get('width', triggerWidth))
+			step = int(spec['step']) if 'step' in spec else None
+			after = int(spec.get('after', spec.get('delay', 0)))
+		except (TypeError, ValueError):
+			return None
+		if not (0 < width <= maxPulseDelay and 0 <= after <= maxPulseDelay) or (step is not None and step < 0):
+			return None
+		triggers.append(OrderedDict((('pin', spec['pin']),
+									 ('mask', 1<<stepperPins[spec['pin']]),
+									 ('step', step),
+									 ('after', None if step is not None else after),
+									 ('width', width),
+									 ('now', 'step' not in spec and 'after' not in spec))))
+	return triggers
+
+def sendTail(schedule, first):
+	# Send the trigger pulses left after a move's last wavelet, synced to follow it
+	global pi, wavePool, sentWaves, txLock
+	pulses = schedule.tail()
+	if not pulses:
+		return
+	try:
+		wid = wavePool.create(pulses)
+	except pigpio.error:
+		print('Trigger Wave Create Failed')
+		return
+	micros = sum(p.delay for p in pulses)
+	with txLock:
+		pi.wave_send_using_mode(wid,pigpio.WAVE_MODE_ONE_SHOT_SYNC)
+		txStart = max(time(), sentWaves[-1][2]) if sentWaves else time()
+		sentWaves.append((wid, txStart, txStart + micros/1000000, first, 0, []))
+
+def fireTriggers(triggers):
+	# Pulse trigger pins from a wave of their own while no move is running, so widths are exact
+	global pi, sentWaves
+	schedule = TriggerSchedule(triggers)
+	sendTail(schedule, 0)
+	if sentWaves:
+		waitForIdle(sentWaves[-1][2])
+	while sentWaves:
+		retireSentWave()
+	pi.clear_bank_1(schedule.mask)
+
+def adaptWavelet(buildTime, micros, full):
+	# Lengthen wavelets when building them takes a large share of their transmit time (high step rates)
+	# and shorten them when it is cheap (low step rates) so stops and blends respond sooner
+	global waveletLength, waveletLoadHigh, waveletLoadLow, engineStats, settings
+	engineStats['wavelets'] += 1
+	engineStats['buildMicros'] += buildTime*1000000
+	engineStats['txMicros'] += micros
+	if not full: # cut short by the end of the move, its load says nothing about the length
+		return
+	load = buildTime*1000000/micros
+	engineStats['lastLoad'] = load
+	engineStats['peakLoad'] = max(load, engineStats['peakLoad'])
+	if load > waveletLoadHigh:
+		waveletLength *= 1.25
+	elif load < waveletLoadLow:
+		waveletLength *= 0.9
+	waveletLength = min(max(waveletLength, settings.Wavelet_Min), settings.Wavelet_Max)
+
+def engineStatus():
+	global waveletLength, engineStats, settings, timings
+	stats = OrderedDict(engineStats)
+	stats['buildMicros'] = round(stats['buildMicros'])
+	stats['meanLoad'] = engineStats['buildMicros']/engineStats['txMicros'] if engineStats['txMicros'] else 0
+	stats['waveletLength'] = round(waveletLength)
+	stats['waveletMin'] = settings.Wavelet_Min
+	stats['waveletMax'] = settings.Wavelet_Max
+	stats['timings'] = OrderedDict((name, timings[name].summary()) for name in timings)
+	return stats
+
+def discardReadyWaves():
+	global wavePool, readyWaves
+	while readyWaves:
+		try:
+			wavePool.delete(readyWaves.popleft()[0])
+		except:
+			print('Wave Delete Failed')
+
+def retireSentWave():
+	global wavePool, sentWaves, txLock
+	try:
+		with txLock:
+			wid = sentWaves.popleft()[0]
+		wavePool.delete(wid)
+	except:
+		print('Wave Delete Failed')
+
+def waitForTx(waveId, startTime):
+	# Sleep until waveId is expected to be transmitting, then confirm with pigpiod
+	global pi, stopFlag, txWakeMargin, timings
 	notx = pigpio.NO_TX_WAVE
 	nowave = pigpio.WAVE_NOT_FOUND
-	while not stopFlag:
-		if stepperState < 2:
-			stepperAwake.clear()
-			if not stepperAwake.wait(0.01):
-				continue
-		sigma = 0.736*settings.Base_Step_Angle*ustepStateMults[settings.Microstep]
-		vel2 = settings.Velocity*settings.Velocity
-		accel = settings.Acceleration
-		decel = settings.Deceleration
-		accelFinished = math.floor(vel2 / (sigma*accel))
-		decelSteps = -math.floor(vel2 / (sigma*decel))
-		if stepsToTake < float('inf'):
-			decelStarted = stepsToTake - decelSteps
-			if decelStarted < accelFinished:
-				accelFinished = int(-stepsToTake*decel / (accel - decel))
-				decelStarted = stepsToTake - accelFinished
-				decelSteps = stepsToTake - decelStarted
-		else:
-			decelStarted = float('inf')
-		startPos = settings.Stepper_Position
-		n = int(0)
-		C = C0
-		lastWave = None
-		waveBeforeLast = None
-		#print('Accelerate ' + str(accelFinished) + ' steps\nDecelerate ' + str(decelSteps) + ' steps')
-		moveStartTime = time()
-		while stepperState > 1 and not stopFlag:
-			wave = []
-			pulses = math.ceil(25000/C)
-			for ii in range(pulses):
-				wave.append(pigpio.pulse(1<<stepPin,0,5))
-				wave.append(pigpio.pulse(0,1<<stepPin,round(C-5)))
-				n += 1
-				if n >= stepsToTake:
-					break
-				if n <= accelFinished:
-					C = C - (2*C * (accelFinished-n) / ((4*n+1)*(accelFinished)))
-				elif n >= decelStarted:
-					C = C - (2*C * (n-decelStarted) / ((4*(n-stepsToTake)+1)*(stepsToTake-decelStarted-1)))
-			try:
-				pi.wave_add_generic(wave)
-			except:
-				print(wave)
-				raise
+	calls = timings['pigpiodCall']
+	delay = startTime - time() - txWakeMargin
+	if delay > 0:
+		sleep(delay)
+	start = time()
+	CW = pi.wave_tx_at() # current wave ID
+	calls.add((time() - start)*1000000)
+	while CW != notx and CW != nowave and CW != waveId and not stopFlag:
+		sleep(0.0005)
+		start = time()
+		CW = pi.wave_tx_at()
+		calls.add((time() - start)*1000000)
+
+def waitForIdle(endTime):
+	# Sleep until transmission is expected to end, then confirm with pigpiod
+	global pi, stopFlag
+	delay = endTime - time()
+	if delay > 0 and not stopFlag:
+		sleep(delay)
+	while not stopFlag and pi.wave_tx_busy():
+		sleep(0.001)
+
+def runMove(movesteps, movetime, velocity=None, scan=None):
+	global pi, wavePool, readyWaves, sentWaves, waveQueueDepth, decelFactor, stepsToTake, movedir
+	global stepperPins, stopFlag, stepperState, moveStartTime, moveMaxTime, settings, programRunning, moveRequests
+	global moveFollows, waveletLength, engineStats, timings, moveStart, txLock, txHalts, armedTriggers, moveGeneration
+	halts = txHalts
+	generation = moveGeneration
+	schedule = None
+	if armedTriggers:
+		schedule = TriggerSchedule(armedTriggers)
+		armedTriggers = []
+	stepPin = stepperPins['Step']
+	stepMask = 1<<stepPin
+	stepOn = pigpio.pulse(stepMask,0,5)
+	moveEntry = time()
+	if movesteps < 0 or movetime < 0:
+		startMove('CCW')
+	else:
+		startMove('CW')
+	stepsToTake = abs(movesteps)
+	moveMaxTime = abs(movetime)
+	plan = planRamp(stepsToTake, velocity)
+	planned = rampKey() # settings the profile was planned with
+	accelFinished = plan.accelFinished
+	decelStarted = plan.decelStarted
+	decelSteps = plan.decelSteps
+	profile = plan
+	base = 0 # step number of profile[0]
+	startPos = settings.Stepper_Position
+	moveStart = startPos
+	n = int(0) # steps built into waves
+	sentN = int(0) # steps handed to pigpiod
+	cleared = False
+	#print('Accelerate ' + str(accelFinished) + ' steps\nDecelerate ' + str(decelSteps) + ' steps')
+	moveStartTime = time()
+	while 1 < stepperState < 5 and not stopFlag:
+		if stepperState < 4 and stepsToTake < infinity and velocity is None and not moveFollows and moveRequests.qsize():
+			extra = blendableMove(startPos + movedir*stepsToTake)
+			if extra: # continue into the next move without decelerating
+				discardReadyWaves()
+				n = sentN
+				if schedule:
+					schedule.rewind(n)
+				C = profile[min(n-base,len(profile)-1)]
+				remaining = stepsToTake - n + extra
+				plan, entry = planBlend(C, remaining)
+				profile = plan
+				base = n - entry
+				stepsToTake = n + remaining
+				accelFinished = base + plan.accelFinished
+				decelStarted = base + plan.decelStarted
+				decelSteps = plan.decelSteps
+				planned = rampKey()
+		if velocity is None and 1 < stepperState < 4 and rampKey() != planned: # ramp to new settings mid-move
+			planned = rampKey()
+			C = profile[min(sentN-base,len(profile)-1)]
+			retarget = planRetarget(C, stepsToTake - sentN)
+			if retarget:
+				discardReadyWaves()
+				n = sentN
+				if schedule:
+					schedule.rewind(n)
+				plan, entry = retarget
+				profile = plan
+				base = n - entry
+				accelFinished = base + plan.accelFinished
+				decelStarted = base + plan.decelStarted
+				decelSteps = plan.decelSteps
+				if 1 < stepperState < 4 and generation == moveGeneration: # not stopped while replanning
+					stepperState = 2
+					if generation != moveGeneration: # stopped between the check and the state change
+						stepperState = 4
+				engineStats['retargets'] += 1
+		while len(readyWaves) < waveQueueDepth and n < stepsToTake:
+			ii = n - base
+			C = profile[min(ii,len(profile)-1)]
+			pulses = min(math.ceil(waveletLength/C), wavePool.maxSteps*2//3 if schedule else wavePool.maxSteps)
+			full = pulses <= stepsToTake - n
+			pulses = min(pulses, stepsToTake - n)
+			buildStart = time()
+			delays = waveletDelays(profile, ii, pulses)
 			try:
-				newWave = pi.wave_create()
-			except:
-				pi.wave_clear()
-				pi.wave_add_generic(wave)
-				newWave = pi.wave_create()
-				lastWave = None
-				waveBeforeLast = None
-			CW = pi.wave_tx_at() # current wave ID
-			while CW != notx and CW != nowave and CW != lastWave and not stopFlag:
-				sleep(0.001)
-				CW = pi.wave_tx_at()
-			if not stopFlag:
-				blocks = pi.wave_send_using_mode(newWave,pigpio.WAVE_MODE_ONE_SHOT_SYNC)
-				settings.Stepper_Position = startPos + (movedir * n)
-			if waveBeforeLast:
-				try:
-					pi.wave_delete(waveBeforeLast)
-				except:
-					print('Wave Delete Failed')
-					pass
-			waveBeforeLast = lastWave
-			lastWave = newWave
-			if n > accelFinished and stepperState == 2:
-				stepperState = 3
-			if n >= decelStarted and stepperState == 3:
-				stepperState = 4
-			if time() - moveStartTime >= moveMaxTime and stepperState < 4:
-				stepperState = 4
-			if stepperState == 4 and decelStarted > n:
-				accelFinished = 0
-				decelStarted = n
-				stepsToTake = n + min(n/decelFactor,decelSteps)
+				newWave = createWave(delays, stepOn, stepMask, schedule.wavelet(n, delays) if schedule else None)
+			except pigpio.error:
+				if schedule:
+					schedule.rewind(n)
+				break # out of wave space, send what is ready and retry once a slot is retired
+			micros = sum(delays) + 5*pulses
+			buildTime = time() - buildStart
+			timings['waveBuild'].add(buildTime*1000000)
+			adaptWavelet(buildTime, micros, full)
+			readyWaves.append((newWave, n, pulses, micros, delays))
+			n += pulses
+		if not readyWaves:
 			if n >= stepsToTake:
-				stepperState = 1
-		#print('Stopping')
-		# settings.Stepper_Position = settings.Stepper_Position + (movedir * n)
-		while not stopFlag and pi.wave_tx_busy():
-			sleep(0.001)
-		#print('Took ' + str(n) + ' steps')
-		if waveBeforeLast:
-			pi.wave_delete(waveBeforeLast)
-		if lastWave:
-			pi.wave_delete(lastWave)
-		if settings.Auto_Disable and stepperState == 1:
+				break
+			# out of wave space - free the oldest waves in order and retry, clear only as a last resort
+			if len(sentWaves) > 1:
+				waitForTx(sentWaves[-1][0], sentWaves[-1][1])
+				while len(sentWaves) > 1:
+					retireSentWave()
+			elif sentWaves:
+				waitForIdle(sentWaves[-1][2])
+				retireSentWave()
+			elif not cleared:
+				wavePool.clear()
+				cleared = True
+			else:
+				raise pigpio.error('JWBCamPIGPIO unable to create wave')
+			continue
+		cleared = False
+		if sentWaves:
+			waitStart = time()
+			waitForTx(sentWaves[-1][0], sentWaves[-1][1])
+			timings['waitForTx'].add((time() - waitStart)*1000000)
+			while len(sentWaves) > 1:
+				retireSentWave()
+		if stopFlag:
+			break
+		timings['waveQueue'].add(len(readyWaves))
+		newWave, first, pulses, micros, delays = readyWaves.popleft()
+		now = time()
+		if sentWaves and now > sentWaves[-1][2]: # transmitter ran dry before this wavelet was ready
+			engineStats['underruns'] += 1
+			waveletLength = min(2*waveletLength, settings.Wavelet_Max)
+		with txLock:
+			if halts != txHalts: # emergency stopped, nothing more may be sent
+				readyWaves.appendleft((newWave, first, pulses, micros, delays))
+				break
+			pi.wave_send_using_mode(newWave,pigpio.WAVE_MODE_ONE_SHOT_SYNC)
+			txStart = max(now, sentWaves[-1][2]) if sentWaves else now
+			sentWaves.append((newWave, txStart, txStart + micros/1000000, first, pulses, delays))
+			sentN = first + pulses
+			settings.Stepper_Position = startPos + (movedir * sentN) # before an estop can set where it stopped
+		timings['pigpiodCall'].add((time() - now)*1000000)
+		if not first: # the first wavelet of the move
+			timings['moveLatency'].add((time() - moveEntry)*1000000)
+		if schedule:
+			schedule.sent(first)
+		if scan:
+			scan.sent(txStart, first, pulses, delays)
+		if sentN > accelFinished and stepperState == 2:
+			stepperState = 3
+		if sentN >= decelStarted and stepperState == 3:
+			stepperState = 4
+		if now - moveStartTime >= moveMaxTime and 1 < stepperState < 4:
+			stepperState = 4
+		if stepperState == 4 and decelStarted > sentN:
+			discardReadyWaves()
+			n = sentN
+			if schedule:
+				schedule.rewind(n)
+			C = profile[min(n-base,len(profile)-1)]
+			accelFinished = 0
+			decelStarted = n
+			profile, decelSteps = planStop(C, int(min(n/decelFactor,decelSteps)))
+			stepsToTake = n + decelSteps
+			base = n
+		if sentN >= stepsToTake: # Waiting if a program or queued move follows
+			stepperState = 5 if programRunning or moveFollows or moveRequests.qsize() else 1
+		statusChanged()
+	#print('Stopping')
+	discardReadyWaves()
+	if schedule and halts == txHalts and generation == moveGeneration and not stopFlag:
+		sendTail(schedule, sentN) # only for moves that were not stopped
+	if sentWaves and halts == txHalts: # an estop has already halted the transmitter
+		waitForIdle(sentWaves[-1][2])
+	#print('Took ' + str(sentN) + ' steps')
+	while sentWaves:
+		retireSentWave()
+	if schedule and schedule.fired:
+		pi.clear_bank_1(schedule.mask) # no trigger line left active by a stopped move
+	if scan and (halts != txHalts or stopFlag):
+		scan.finish()
+	return generation == moveGeneration and halts == txHalts and not stopFlag # not stopped
+
+def emergencyStop(received):
+	# Priority stop run by the command server - halt the transmitter at once without waiting for the
+	# motion thread, drop queued moves and programs, and estimate where the motor stopped from the
+	# step timing of the wavelets handed to pigpiod. received is when the command arrived
+	global pi, txLock, txHalts, sentWaves, stepperState, settings, moveStart, movedir, timings
+	with txLock:
+		txHalts += 1
+		pi.wave_tx_stop()
+		stopped = time()
+		onAir = list(sentWaves)
+	abortProgram()
+	flushMoves()
+	position = settings.Stepper_Position
+	lastPulse = 0
+	for wid, txStart, txEnd, first, pulses, delays in onAir:
+		if not pulses: # trigger pulses only
+			continue
+		edges = txStart + np.concatenate(([0], np.cumsum(np.array(delays[:-1]) + 5)))/1000000
+		done = int(np.searchsorted(edges, stopped, 'right'))
+		if done:
+			lastPulse = edges[done-1]
+		if done < pulses: # halted part way through this wavelet, later ones never started
+			position = moveStart + movedir*(first + done)
+			break
+	moving = stepperState > 1
+	if moving:
+		stepperState = 1
+	settings.Stepper_Position = position
+	statusChanged()
+	timings['estop'].add((stopped - received)*1000000)
+	return OrderedDict((('stopped', moving),
+						('position', position),
+						('receivedToHalt_us', round((stopped - received)*1000000, 1)),
+						('receivedToLastPulse_us', round(max(0, lastPulse - received)*1000000, 1))))
+
+def programSteps(op, value, position=None):
+	# Steps for a move operation, absolute targets resolved against position (default current position)
+	global settings
+	if position is None:
+		position = settings.Stepper_Position
+	if op == 'step':
+		return int(value)
+	if op == 'stepTo':
+		return int(value) - position
+	if op == 'move':
+		return dist2step(float(value))[0]
+	return dist2step(float(value) - step2dist(position))[0]
+
+def programWait(seconds=infinity, signal=None):
+	# Block the motion thread for a dwell or until a signal arrives, returns False if aborted
+	global programCondition, programSignals, programAbort, stopFlag
+	deadline = time() + seconds
+	with programCondition:
+		while not programAbort and not stopFlag:
+			if signal is not None and signal in programSignals:
+				programSignals.discard(signal)
+				return True
+			remaining = deadline - time()
+			if remaining <= 0:
+				return signal is None
+			programCondition.wait(None if remaining == infinity else remaining)
+	return False
+
+def runProgram(ops):
+	# Run every operation back to back in the motion thread, logging each completion
+	global programRunning, programAbort, programLog, stepperState, settings
+	programStart = time()
+	for index, operation in enumerate(ops):
+		if programAbort or stopFlag:
+			break
+		op = operation['op']
+		value = operation[programOps[op]]
+		started = time()
+		if op == 'dwell':
+			stepperState = 5
+			statusChanged()
+			completed = programWait(float(value))
+		elif op == 'wait':
+			stepperState = 5
+			statusChanged()
+			completed = programWait(float(operation.get('timeout', infinity)), str(value))
+		elif op == 'run':
+			stepperState = 2
+			runMove(infinity, float(value))
+			completed = not programAbort
+		else:
+			steps = programSteps(op, value)
+			completed = True
+			if abs(steps) >= 2:
+				stepperState = 2
+				runMove(steps, infinity)
+				completed = not programAbort
+		programLog.append(OrderedDict((('index', index),
+									   ('op', op),
+									   ('started', started),
+									   ('finished', time()),
+									   ('elapsed', time() - programStart),
+									   ('position', settings.Stepper_Position),
+									   ('completed', completed))))
+		statusChanged()
+		if not completed:
+			break
+	stepperState = 1
+	programRunning = False
+
+def runScan(scan, generation):
+	# Move to the scan origin at the Velocity setting, then run the scan move through every frame
+	global stepperState, settings, armedTriggers, moveGeneration, txHalts, scanLog, moveFollows
+	halts = txHalts
+	scanLog = OrderedDict((('running', True), ('frames', len(scan.steps)), ('captured', scan.captured)))
+	statusChanged()
+	steps = scan.origin - settings.Stepper_Position
+	if steps:
+		moveFollows = True
+		runMove(steps, infinity)
+		moveFollows = False
+	if generation == moveGeneration and halts == txHalts and not stopFlag:
+		stepperState = 2
+		if generation == moveGeneration: # not stopped between the check and the state change
+			armedTriggers = armedTriggers + scan.triggers
+			runMove(scan.direction*scan.moveSteps, infinity, scan.velocity, scan)
+	for timer in scan.timers:
+		timer.join()
+	scanLog['running'] = False
+	pushEvent(OrderedDict((('event', 'scan'), ('frames', len(scan.steps)), ('captured', len(scan.captured)))))
+	statusChanged()
+
+def blendableMove(endPosition):
+	# Take the next queued move if it continues in the current direction, returns its steps or 0
+	global moveRequests, moveGeneration, movedir, moveWaiters
+	with moveRequests.mutex:
+		if not moveRequests.queue:
+			return 0
+		request = moveRequests.queue[0]
+		if request is None or request[0] != 'move' or request[1] == 'run' or request[3] != moveGeneration:
+			return 0
+		steps = programSteps(request[1], request[2], endPosition)
+		if abs(steps) < 2 or (steps > 0) != (movedir > 0):
+			return 0
+		moveRequests.queue.popleft()
+		moveRequests.not_full.notify()
+	moveWaiters.append(request[4])
+	return abs(steps)
+
+def flushMoves():
+	global moveRequests, moveGeneration
+	moveGeneration += 1
+
+def stepperControl():
+	global stopFlag, stepperState, settings, moveRequests, moveGeneration, programRunning, timings, enablePending
+	global moveWaiters
+	while not stopFlag:
+		request = moveRequests.get()
+		if request is None or stopFlag:
+			break
+		timings['moveQueue'].add(moveRequests.qsize())
+		if request[0] == 'program':
+			if stepperState > 1:
+				runProgram(request[1])
+			else: # hard stopped before the program started
+				programRunning = False
+		elif request[0] == 'trigger':
+			if request[3] == moveGeneration:
+				fireTriggers(request[1])
+		elif request[0] == 'scan':
+			if request[3] == moveGeneration and stepperState > 1:
+				runScan(request[1], request[3])
+		elif request[0] == 'wait': # everything queued before it has finished
+			moveFinished([request[4]], 'idle', True, time())
+		elif request[3] == moveGeneration: # not flushed by a stop since it was queued
+			op, value = request[1], request[2]
+			started = time()
+			moveWaiters = [request[4]]
+			stepperState = 2
+			completed = True
+			if request[3] != moveGeneration: # stopped between the check above and the state change
+				completed = False
+			elif op == 'run':
+				completed = runMove(infinity, value)
+			else:
+				steps = programSteps(op, value)
+				if abs(steps) >= 2:
+					completed = runMove(steps, infinity)
+				else:
+					stepperState = 1
+			moveFinished(moveWaiters, op, completed, started)
+		elif request[0] == 'move':
+			moveFinished([request[4]], request[1], False, time()) # flushed
+		if stepperState > 1 and not moveRequests.qsize(): # flushed while waiting to start
+			stepperState = 1
+		if settings.Auto_Disable and stepperState == 1 and not moveRequests.qsize():
 			disable()
+		elif enablePending and not moveRequests.qsize(): # flushed before a move could enable the driver
+			enable()
+		statusChanged()
+
+def moveFinished(waiters, op, completed, started):
+	# Tell each client that watched a move it has ended - completed is False if it was stopped or
+	# flushed before it could start. Moves blended into one end together
+	global settings, moveWaiters
+	for waiter in waiters:
+		if waiter:
+			pushEvent(OrderedDict((('event', 'move'),
+								   ('op', op),
+								   ('completed', completed),
+								   ('position', settings.Stepper_Position),
+								   ('started', started),
+								   ('finished', time()))), waiter)
+	moveWaiters = []
 
-def move(movesteps=float('inf'),movetime=10):
-	global stepsToTake, stepperState, stepperAwake, moveMaxTime
-	if stepperState > 1:
+def startProgram(ops):
+	global stepperState, moveRequests, programRunning, programAbort, programLog, programSignals, maxMoveSteps
+	if stepperState > 1 or programRunning or moveRequests.qsize():
 		return 'busy'
+	if not isinstance(ops, list) or not ops:
+		return 'invalid'
+	for operation in ops:
+		if not isinstance(operation, dict) or operation.get('op') not in programOps:
+			return 'invalid'
+		value = operation.get(programOps[operation['op']])
+		if value is None:
+			return 'invalid'
+		if 'timeout' in operation:
+			try:
+				timeout = float(operation['timeout'])
+			except (TypeError, ValueError):
+				return 'invalid'
+			if not timeout >= 0: # NaN or negative
+				return 'invalid'
+		if operation['op'] != 'wait':
+			try:
+				value = float(value)
+			except (TypeError, ValueError):
+				return 'invalid'
+			if math.isnan(value):
+				return 'invalid'
+			if operation['op'] in ('step', 'stepTo', 'move', 'moveTo') and \
+			   not (math.isfinite(value) and abs(programSteps(operation['op'], value)) <= maxMoveSteps):
+				return 'invalid'
 	if stepperState == 0:
 		enable()
-	if movesteps < 0 or movetime < 0:
-		setdir('CCW')
-		movesteps = abs(movesteps)
-		movetime = abs(movetime)
-	else:
-		setdir('CW')
-	stepsToTake = movesteps
-	moveMaxTime = movetime
-	# print('Taking ' + str(stepsToTake) + ' steps over a maximum of ' + str(runtime) + ' seconds')
+	with programCondition:
+		programSignals.clear()
+	programLog = []
+	programAbort = False
+	programRunning = True
 	stepperState = 2
-	if not stepperAwake.is_set():
-		stepperAwake.set()
+	moveRequests.put(('program', ops))
+	statusChanged()
+	return 'success'
+
+def startScan(spec):
+	global stepperState, moveRequests, programRunning, settings, moveGeneration
+	if stepperState > 1 or programRunning or moveRequests.qsize():
+		return 'busy'
+	if not isinstance(spec, dict):
+		return 'invalid'
+	try:
+		scan = Scan(spec, settings.Stepper_Position)
+	except (KeyError, TypeError, ValueError):
+		return 'invalid'
+	if stepperState == 0:
+		enable()
+	stepperState = 2
+	moveRequests.put(('scan', scan, None, moveGeneration))
+	statusChanged()
+	return 'success'
+
+def abortProgram():
+	global programRunning, programAbort, programCondition
+	if not programRunning:
+		return
+	with programCondition:
+		programAbort = True
+		programCondition.notify_all()
+
+def move(op, value, client=None):
+	# Queue a step, stepTo, move, moveTo or run operation behind any move in progress. A client
+	# watching the command is sent an event when the move ends
+	global stepperState, moveRequests, moveQueueLimit, moveGeneration, programRunning, maxMoveSteps
+	if programRunning or moveRequests.qsize() >= moveQueueLimit:
+		return 'busy'
+	if op != 'run' and abs(programSteps(op, value)) > maxMoveSteps:
+		return 'invalid'
+	if stepperState == 0:
+		enable(defer=True) # the pin is written by startMove with the direction
+	# print('Queueing ' + op + ' ' + str(value))
+	if stepperState < 2:
+		stepperState = 2
+	waiter = (client, client.requestId) if client and client.watching else None
+	moveRequests.put(('move',op,value,moveGeneration,waiter))
+	statusChanged()
 	return 'success'
 
-def parseMessage(message):
-	global stepperState, stepperStates, decelFactor, stopFlag, running, settings, dir2pin
-	if   message.startswith('stop'): # soft stop - stop from present state with deceleration
+def inBounds(name, val):
+	# True if val is within the fullSettingsList range of a bounded setting
+	global fullSettingsList
+	low, high = fullSettingsList[name][3]
+	return low <= val <= high
+
+def parseMessage(message, client=None):
+	global stepperState, stepperStates, decelFactor, stopFlag, running, settings, dir2pin, armedTriggers
+	if   message.startswith('estop'): # emergency stop - halt step pulses immediately, replies with a latency report
+		return emergencyStop(client.received if client else time())
+	elif message.startswith('stop'): # soft stop - stop from present state with deceleration
+		abortProgram()
+		flushMoves()
 		if stepperState > 1:
 			stepperState = 4
+		statusChanged()
 		return 'success'
 	elif message.startswith('hard'): # hard stop - no more steps
+		abortProgram()
+		flushMoves()
 		if stepperState > 1:
 			stepperState = 1
+		statusChanged()
 		return 'success'
 	elif message.startswith('disable'): # Disable the stepper motor driver
 		disable()
@@ -363,21 +1569,16 @@ def parseMessage(message):
 		else:
 			return 'invalid'
 	elif message.startswith('stepTo'):
-		if stepperState > 1:
-			return 'busy'
 		if len(message) == 6:
 			return 'invalid'
 		try:
 			position = int(message[6:])
 		except ValueError:
 			return 'invalid'
-		steps = position-settings.Stepper_Position
-		if abs(steps) < 2:
+		if stepperState < 2 and abs(programSteps('stepTo',position)) < 2:
 			return 'invalid'
-		return move(steps,infinity)
+		return move('stepTo',position,client)
 	elif message.startswith('step'): # step a certain number of steps
-		if stepperState > 1:
-			return 'busy'
 		if len(message) == 4:
 			return 'invalid'
 		try:
@@ -386,36 +1587,28 @@ def parseMessage(message):
 			return 'invalid'
 		if abs(steps) < 2:
 			return 'invalid'
-		return move(steps,infinity)
+		return move('step',steps,client)
 	elif message.startswith('moveTo'):
-		if stepperState > 1:
-			return 'busy'
 		if len(message) == 6:
 			return 'invalid'
 		try:
 			destination = float(message[6:])
 		except ValueError:
 			return 'invalid'
-		steps, dist = dist2step(destination - step2dist(settings.Stepper_Position))
-		if abs(steps) < 2:
+		if stepperState < 2 and abs(programSteps('moveTo',destination)) < 2:
 			return 'invalid'
-		return move(steps,infinity)
+		return move('moveTo',destination,client)
 	elif message.startswith('move'): # move a certain number distance
-		if stepperState > 1:
-			return 'busy'
 		if len(message) == 4:
 			return 'invalid'
 		try:
 			moveDist = float(message[4:])
 		except ValueError:
 			return 'invalid'
-		steps, dist = dist2step(moveDist)
-		if abs(steps) < 2:
+		if abs(programSteps('move',moveDist)) < 2:
 			return 'invalid'
-		return move(steps,infinity)
+		return move('move',moveDist,client)
 	elif message.startswith('run'):
-		if stepperState > 1:
-			return 'busy'
 		if len(message) > 3:
 			try:
 				val = float(message[3:])
@@ -423,7 +1616,7 @@ def parseMessage(message):
 				return 'invalid'
 		else:
 			val = infinity
-		return move(infinity,val)
+		return move('run',val,client)
 	elif message.startswith('enable'): # Enable the stepper motor driver
 		enable()
 		return 'success'
@@ -432,8 +1625,7 @@ def parseMessage(message):
 			return str(settings.Microstep)
 		if stepperState > 1:
 			return 'busy'
-		if message.endswith(('1','2','4','8','16','32')):
-			stepSize(int(message[9:]))
+		if message.endswith(('1','2','4','8','16','32')) and stepSize(int(message[9:])):
 			return 'success'
 		else:
 			return 'invalid'
@@ -444,8 +1636,8 @@ def parseMessage(message):
 			val = float(message[8:])
 		except ValueError:
 			return 'invalid'
-		settings.Velocity = val
-		compC0()
+		if not inBounds('Velocity', val) or not changeSettings({'Velocity':val}):
+			return 'invalid'
 		return str(val)
 	elif message.startswith('Acceleration'): # set acceleration - radians per second per second
 		if len(message) == 12:
@@ -454,11 +1646,9 @@ def parseMessage(message):
 			val = float(message[12:])
 		except ValueError:
 			return 'invalid'
-		if val <= 0:
+		if not inBounds('Acceleration', val) or not changeSettings({'Acceleration':val}):
 			return 'invalid'
-		settings.Acceleration = val
 		decelFactor = -settings.Deceleration/settings.Acceleration
-		compC0()
 		return str(val)
 	elif message.startswith('Deceleration'): # set relative deceleration speed - positive scalar factor
 		if len(message) == 12:
@@ -467,11 +1657,49 @@ def parseMessage(message):
 			val = float(message[12:])
 		except ValueError:
 			return 'invalid'
-		if val >= 0:
+		if not inBounds('Deceleration', val) or not changeSettings({'Deceleration':val}):
 			return 'invalid'
-		settings.Deceleration = val
 		decelFactor = -settings.Deceleration/settings.Acceleration
-		compC0()
+		return str(val)
+	elif message.startswith('Wavelet_Min'): # set shortest wavelet - microseconds
+		if len(message) == 11:
+			return str(settings.Wavelet_Min)
+		try:
+			val = int(message[11:])
+		except ValueError:
+			return 'invalid'
+		if not inBounds('Wavelet_Min', val) or val > settings.Wavelet_Max:
+			return 'invalid'
+		settings.Wavelet_Min = val
+		return str(val)
+	elif message.startswith('Wavelet_Max'): # set longest wavelet - microseconds
+		if len(message) == 11:
+			return str(settings.Wavelet_Max)
+		try:
+			val = int(message[11:])
+		except ValueError:
+			return 'invalid'
+		if not inBounds('Wavelet_Max', val) or val < settings.Wavelet_Min:
+			return 'invalid'
+		settings.Wavelet_Max = val
+		return str(val)
+	elif message.startswith('Profile'): # select the motion profile planner
+		if len(message) == 7:
+			return settings.Profile
+		if stepperState > 1:
+			return 'busy'
+		if message[7:] not in ('Trapezoid','S-Curve') or not changeSettings({'Profile':message[7:]}):
+			return 'invalid'
+		return settings.Profile
+	elif message.startswith('Jerk'): # set jerk limit for the S-Curve profile - radians per second cubed
+		if len(message) == 4:
+			return str(settings.Jerk)
+		try:
+			val = float(message[4:])
+		except ValueError:
+			return 'invalid'
+		if not inBounds('Jerk', val) or not changeSettings({'Jerk':val}):
+			return 'invalid'
 		return str(val)
 	elif message.startswith('Stepper_Position'): # set relative deceleration speed - positive scalar factor
 		if stepperState > 1:
@@ -501,9 +1729,10 @@ def parseMessage(message):
 		if len(message) == 12:
 			settings.Auto_Disable = not settings.Auto_Disable
 			return str(settings.Auto_Disable)
-		if str(val) not in ['True','False']:
+		val = message[12:]
+		if val not in ['True','False']:
 			return 'invalid'
-		if str(val) == 'True':
+		if val == 'True':
 			settings.Auto_Disable = True
 		else:
 			settings.Auto_Disable = False
@@ -517,8 +1746,9 @@ def parseMessage(message):
 			val = float(message[15:])
 		except ValueError:
 			return 'invalid'
-		settings.Base_Step_Angle = val
-		settings.Steps_Per_Rotation = round(2 * math.pi / val)
+		if not inBounds('Base_Step_Angle', val) or \
+		   not changeSettings({'Base_Step_Angle':val, 'Steps_Per_Rotation':round(2 * math.pi / val)}):
+			return 'invalid'
 		return str(val)
 	elif message.startswith('Steps_Per_Rotation'):
 		if len(message) == 18:
@@ -527,19 +1757,106 @@ def parseMessage(message):
 			val = int(message[18:])
 		except ValueError:
 			return 'invalid'
-		settings.Steps_Per_Rotation = val
-		settings.Base_Step_Angle = 2 * math.pi / val
+		if not inBounds('Steps_Per_Rotation', val) or \
+		   not changeSettings({'Steps_Per_Rotation':val, 'Base_Step_Angle':2 * math.pi / val}):
+			return 'invalid'
 		return str(val)
 	elif message.startswith('flipdir'):
 		valP = dir2pin[1]
 		valN = dir2pin[-1]
 		dir2pin.update({1:valN,-1:valP})
 		return 'success'
+	elif message.startswith('subscribe'): # push status events to this connection, optional minimum interval in seconds
+		if client is None or not client.framed:
+			return 'invalid'
+		try:
+			interval = float(message[9:]) if len(message) > 9 else 0.1
+		except ValueError:
+			return 'invalid'
+		client.subscription = client.requestId
+		client.interval = max(interval, 0.0)
+		client.lastStatus = {}
+		client.lastPublished = 0
+		return 'success'
+	elif message.startswith('unsubscribe'):
+		if client is None:
+			return 'invalid'
+		client.subscription = None
+		return 'success'
+	elif message.startswith('programstatus'): # progress and per operation completion times of the last program
+		return OrderedDict((('running', programRunning),
+							('aborted', programAbort),
+							('operations', programLog)))
+	elif message.startswith('program'): # run a JSON list of operations back to back
+		try:
+			ops = json.loads(message[7:])
+		except ValueError:
+			return 'invalid'
+		return startProgram(ops)
+	elif message.startswith('signal'): # raise a named signal for a program wait operation
+		if len(message) == 6:
+			return 'invalid'
+		with programCondition:
+			programSignals.add(message[6:])
+			programCondition.notify_all()
+		return 'success'
+	elif message.startswith('waitidle'): # with FRAME_WATCH, an event once moves queued so far have finished
+		if client is None or not client.watching:
+			return 'invalid'
+		moveRequests.put(('wait', None, None, moveGeneration, (client, client.requestId)))
+		return 'success'
+	elif message.startswith('estimate'): # duration of a move command without running it, eg estimatestep2000
+		command = message[8:]
+		for op in ('stepTo','step','moveTo','move','run'): # longest prefix first
+			if command.startswith(op):
+				break
+		else:
+			return 'invalid'
+		try:
+			value = float(command[len(op):]) if len(command) > len(op) else infinity
+		except ValueError:
+			return 'invalid'
+		if op == 'run': # negative runs go CCW and take as long
+			if not 0 < abs(value) < infinity:
+				return 'invalid'
+		elif value == infinity or abs(programSteps(op, value)) < 2:
+			return 'invalid'
+		return estimateMove(op, value)
+	elif message.startswith('scanstatus'): # frames captured so far by the last scan
+		return scanLog
+	elif message.startswith('scan'): # continuous scan - json object, see Scan
+		try:
+			spec = json.loads(message[4:])
+		except ValueError:
+			return 'invalid'
+		return startScan(spec)
+	elif message.startswith('trigger'): # shutter / focus pulses - json object or list, see parseTriggers
+		if len(message) == 7:
+			return [OrderedDict((key, trigger[key]) for key in ('pin','step','after','width')) for trigger in armedTriggers]
+		triggers = parseTriggers(message[7:])
+		if triggers is None:
+			return 'invalid'
+		if not triggers: # empty list disarms
+			armedTriggers = []
+			return 'success'
+		now = [trigger for trigger in triggers if trigger['now']]
+		if now and moveRequests.qsize() >= moveQueueLimit:
+			return 'busy'
+		armedTriggers = armedTriggers + [trigger for trigger in triggers if not trigger['now']]
+		if now:
+			moveRequests.put(('trigger', now, None, moveGeneration))
+		return 'success'
+	elif message.startswith('wavepool'): # wave resource occupancy and failure counters
+		if wavePool is None:
+			return 'invalid'
+		return wavePool.stats()
+	elif message.startswith('stats'): # motion engine counters, current wavelet length and hot path timing histograms
+		return engineStatus()
 	elif message.startswith('fullsettings'):
-		return json.dumps(fullSettingsList)
+		return fullSettingsList
 	elif message.startswith('settings'): # send a json encoding of external settings, 
 		# does not indicate stepper state (enabled, and/or running)
-		return json.dumps(settings.list())
+		return settings.list()
 	elif message.startswith('terminate'):
 		stopFlag = True
 		running = False
@@ -547,38 +1864,227 @@ def parseMessage(message):
 	else:
 		return 'invalid'
 
-def comControl():
-	global servesock, message, running
+def parseFrame(ftype, payload, client=None):
+	if ftype not in (FRAME_TEXT, FRAME_WATCH):
+		return 'invalid'
+	if client:
+		client.watching = ftype == FRAME_WATCH
+	return parseMessage(decodePayload(FRAME_TEXT, payload), client)
+
+def statusChanged():
+	# Callable from any thread, updates the shared status block and wakes the command server
+	# to publish status to subscribers
+	publishShared()
+	wakeServer()
+
+def pushEvent(event, waiter=None):
+	# Callable from any thread, queues an event for every subscriber, or for one client tagged with
+	# the request ID it is waiting on if waiter is (client, request ID)
+	global pendingEvents
+	pendingEvents.append((event, waiter))
+	wakeServer()
+
+def wakeServer():
+	global wakeWriter, statusPending
+	if wakeWriter is None or statusPending:
+		return
+	statusPending = True
 	try:
-		messagesock, addr = servesock.accept()
-		messagesock.settimeout(0.01)
-	except:
+		wakeWriter.send(b'\0')
+	except OSError:
+		pass
+
+def publishShared(pid=None):
+	# Copy position, state, direction and the move target into the shared memory status block
+	global statusBlock, statusLock, settings, stepperState, enabled, movedir, moveStart, stepsToTake, statusWritten
+	if statusBlock is None:
 		return
-	connected = True
-	while connected and running:
-		try:
-			chunk = messagesock.recv(64)
-		except socket.timeout:
+	flags = STATUS_ENABLED if enabled else 0
+	target = 0
+	if stepperState > 1 and stepsToTake < infinity:
+		flags |= STATUS_TARGET
+		target = moveStart + movedir*stepsToTake
+	with statusLock:
+		statusWritten = time()
+		statusBlock.write(os.getpid() if pid is None else pid, stepperState, movedir, flags,
+						  int(settings.Stepper_Position), int(target), statusWritten)
+
+def currentStatus():
+	global settings, stepperState, stepperStates
+	status = OrderedDict(settings.list())
+	status['State'] = stepperStates[stepperState]
+	return status
+
+def publishEvents():
+	# Send queued events to their clients, events are never rate limited or merged
+	global clients, pendingEvents
+	while pendingEvents:
+		event, waiter = pendingEvents.popleft()
+		event = json.dumps(event)
+		if waiter:
+			client, requestId = waiter
+			if client.sock in clients: # still connected
+				sendToClient(client, packFrame(FRAME_EVENT, requestId, event))
 			continue
-		except:
-			raise
-		else:
-			if chunk:
-				message = chunk.decode('utf-8')
-				chunk = None
-				reply = parseMessage(message)
-				if reply != None:
-					try:
-						messagesock.send(reply.encode('utf-8'))
-					except:
-						pass
-					message = None
-					reply = None
-			else:
-				messagesock.close()
-				connected = False
-	if connected:
-		messagesock.close()
+		for client in list(clients.values()):
+			if client.subscription is not None:
+				sendToClient(client, packFrame(FRAME_EVENT, client.subscription, event))
+
+def publishStatus():
+	# Send each subscriber the status fields that changed since its last event, at most once per
+	# subscriber interval. Returns the time the next rate limited event is due, or None
+	global clients
+	status = None
+	nextDue = None
+	now = time()
+	for client in list(clients.values()):
+		if client.subscription is None:
+			continue
+		if status is None:
+			status = currentStatus()
+		changes = OrderedDict((k,v) for k,v in status.items() if client.lastStatus.get(k) != v)
+		if not changes:
+			continue
+		due = client.lastPublished + client.interval
+		if now < due:
+			nextDue = due if nextDue is None else min(nextDue, due)
+			continue
+		client.lastStatus = status
+		client.lastPublished = now
+		changes['time'] = now
+		sendToClient(client, packFrame(FRAME_EVENT, client.subscription, json.dumps(changes)))
+	return nextDue
+
+class Client():
+	def __init__(self, sock):
+		self.sock = sock
+		self.reader = FrameReader()
+		self.framed = None # decided by the first byte received, legacy clients send bare text commands
+		self.outgoing = bytearray()
+		self.requestId = 0 # request ID of the frame being handled
+		self.subscription = None # request ID of the subscribe command, events are tagged with it
+		self.interval = 0.1
+		self.lastStatus = {}
+		self.lastPublished = 0
+		self.received = 0 # time the data being handled arrived
+		self.watching = False # the frame being handled asked for an event when its move ends
+
+def acceptClient(sock):
+	global selector, clients
+	try:
+		messagesock, addr = sock.accept()
+	except OSError:
+		return
+	messagesock.setblocking(False)
+	client = Client(messagesock)
+	clients[messagesock] = client
+	selector.register(messagesock, selectors.EVENT_READ, client)
+
+def closeClient(client):
+	global selector, clients
+	clients.pop(client.sock, None)
+	try:
+		selector.unregister(client.sock)
+	except (KeyError, ValueError):
+		pass
+	client.sock.close()
+
+def sendToClient(client, data):
+	# Queue data for the client and write as much as the socket accepts without blocking
+	global selector
+	client.outgoing.extend(data)
+	try:
+		sent = client.sock.send(client.outgoing)
+	except BlockingIOError:
+		sent = 0
+	except OSError:
+		closeClient(client)
+		return
+	del client.outgoing[:sent]
+	events = selectors.EVENT_READ | (selectors.EVENT_WRITE if client.outgoing else 0)
+	selector.modify(client.sock, events, client)
+
+def comControl(client):
+	# Handle whatever the client sent, one reply per complete message
+	try:
+		chunk = client.sock.recv(4096)
+	except BlockingIOError:
+		return
+	except OSError:
+		chunk = b''
+	if not chunk:
+		closeClient(client)
+		return
+	client.received = time()
+	if client.framed is None:
+		client.framed = isFramed(chunk)
+	if client.framed:
+		try:
+			frames = client.reader.feed(chunk)
+		except ProtocolError as ex:
+			sendToClient(client, packFrame(FRAME_ERROR, 0, ex.message))
+			closeClient(client)
+			return
+		for ftype, requestId, payload in frames:
+			start = time()
+			client.requestId = requestId
+			try:
+				reply = parseFrame(ftype, payload, client)
+			except Exception:
+				logging.exception('JWBCamPIGPIO command failed')
+				reply = 'invalid' # one bad command must not take down every connection
+			sendToClient(client, packReply(requestId, reply))
+			timings['dispatch'].add((time() - start)*1000000)
+	else:
+		start = time()
+		try:
+			reply = parseMessage(chunk.decode('utf-8'), client)
+		except Exception:
+			logging.exception('JWBCamPIGPIO command failed')
+			reply = 'invalid'
+		if reply != None:
+			sendToClient(client, encodeLegacy(reply))
+		timings['dispatch'].add((time() - start)*1000000)
+
+def serveClients():
+	# Single event loop serving every command connection. It blocks in select until there is work,
+	# the next rate limited status event or the next status block heartbeat
+	global servesock, selector, running, wakeReader, wakeWriter, statusPending, statusBlock, statusWritten, statusHeartbeat
+	selector = selectors.DefaultSelector()
+	servesock.setblocking(False)
+	selector.register(servesock, selectors.EVENT_READ, None)
+	wakeReader, wakeWriter = socket.socketpair()
+	wakeReader.setblocking(False)
+	wakeWriter.setblocking(False)
+	selector.register(wakeReader, selectors.EVENT_READ, None)
+	nextDue = None
+	while running:
+		due = statusWritten + statusHeartbeat if statusBlock is not None else None
+		if nextDue is not None:
+			due = nextDue if due is None else min(due, nextDue)
+		timeout = None if due is None else max(due - time(), 0)
+		for key, mask in selector.select(timeout):
+			if key.fileobj is servesock:
+				acceptClient(servesock)
+				continue
+			if key.fileobj is wakeReader:
+				statusPending = False
+				try:
+					wakeReader.recv(4096)
+				except BlockingIOError:
+					pass
+				continue
+			client = key.data
+			if mask & selectors.EVENT_WRITE:
+				sendToClient(client, b'')
+			if mask & selectors.EVENT_READ and client.sock in clients:
+				comControl(client)
+			if not running:
+				break
+		publishEvents()
+		nextDue = publishStatus()
+		if time() >= statusWritten + statusHeartbeat:
+			publishShared()
 
 if __name__ == '__main__':
 	
@@ -589,12 +2095,17 @@ if __name__ == '__main__':
 	except:
 		print("JWBCamPIGPIO PIGPIO initialization failed")
 		raise
+	try:
+		statusBlock = StatusBlock(create=True)
+		publishShared()
+	except OSError as ex:
+		print('JWBCamPIGPIO status block unavailable - ' + str(ex))
   
   # Start Server Socket
 	try:
 		servesock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
 		servesock.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
-		servesock.bind('\0JWBCamPIGPIO.sock')
+		servesock.bind(SOCKET_NAME)
 		servesock.listen(2)
 	except:
 		stopPigpio()
@@ -606,19 +2117,7 @@ if __name__ == '__main__':
 	try:
 		stepperController = Thread(target=stepperControl)
 		stepperController.start()
-		comControllers = []
-		while running:
-			r,w,e = select((servesock,),[],[],1)
-			if r:
-				t = Thread(target=comControl)
-				comControllers.append(t)
-				t.start()
-				sleep(0.001)
-			for controller in comControllers:
-				if not controller.is_alive():
-					controller.join(1)
-					comControllers.remove(controller)
-			
+		serveClients()
 	except KeyboardInterrupt as ex:
 		print(ex)
 		print('Exiting via keyboard interrupt')
@@ -638,15 +2137,14 @@ if __name__ == '__main__':
 	finally:
 		if servesock:
 			servesock.close()
+		for client in list(clients.values()):
+			closeClient(client)
 		stopFlag = True
-		if not stepperAwake.is_set():
-			stepperAwake.set()
-		sleep(0.000002)
+		moveRequests.put(None)
 		running = False
 		disable()
 		stopPigpio()
 		if stepperController:
 			stepperController.join()
-		for controller in comControllers:
-			controller.join()
+		publishShared(0) # tells clients mapping the status block that the daemon has gone
 		EXIT(0)
\ No newline at end of file
@@ -9,6 +9,7 @@ from time import sleep
 from weakref import WeakSet
 import socket
 from sys import byteorder as BO
+from jwbprotocol import FrameRing
 
 
 
@@ -20,6 +21,7 @@ class jwbcameraClient():
 	settingsClients = WeakSet()
 	connected = False
 	gpsock = None
+	frames = None
 
 	def __init__(self):
 		self.gpsock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
@@ -43,4 +45,16 @@ class jwbcameraClient():
 				self.settings = None
 			else:
 				self.settings = json.loads(encoded.decode('utf-8'), object_pairs_hook=OrderedDict)
-				
\ No newline at end of file
+	
+	def getImage(self, seq=None):
+		# Latest complete frame from JWBCamGphoto, or frame seq from an image notification, as
+		# (seq, time, jpeg bytes). None if there is no such frame in the ring
+		if self.frames is None:
+			try:
+				self.frames = FrameRing()
+			except OSError:
+				return None
+		frame = self.frames.read(seq)
+		if frame is not None:
+			self.lastImage = frame[2]
+		return frame
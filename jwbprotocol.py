@@ -0,0 +1,250 @@
+#!/usr/bin/python3
+
+# Framed message protocol for the JWBCamPIGPIO socket
+#
+# Every frame is a fixed 12 byte header followed by the payload
+#   magic		1 byte	0xA5, never a valid first byte of a legacy text command
+#   version		1 byte	PROTOCOL_VERSION
+#   type		1 byte	one of the FRAME_* payload types
+#   flags		1 byte	reserved, 0
+#   request id	4 bytes	chosen by the client, echoed in the reply
+#   length		4 bytes	payload length in bytes
+# All header fields are network byte order. Payloads are utf-8 text or utf-8 encoded JSON.
+#
+# Stepper status is also published in a small shared memory block, STATUS_PATH, using a seqlock
+#   sequence	8 bytes	odd while the daemon is writing, bumped to the next even value when done
+#   pid			4 bytes	daemon process id, 0 once the daemon has exited
+#   state		1 byte	key of stepperStates
+#   direction	1 byte	signed, 1 CW or -1 CCW
+#   flags		2 bytes	STATUS_ENABLED, STATUS_TARGET
+#   position	8 bytes	signed step position
+#   target		8 bytes	signed step position the active move will stop at, valid with STATUS_TARGET
+#   time		8 bytes	double, time.time() of the update
+# Native byte order, the block never leaves the machine. Readers retry while the sequence is odd or
+# changed during the read.
+#
+# Camera frames are shared through a ring of FRAME_SLOTS slots in FRAME_PATH, written by JWBCamGphoto
+#   ring header	latest	8 bytes	sequence number of the newest complete frame, 0 before the first
+#				slots	4 bytes	slot count
+#				size	4 bytes	frame bytes per slot
+#   each slot	seq		8 bytes	sequence number of the frame in the slot
+#				length	4 bytes	frame length in bytes
+#				ready	1 byte	1 once the frame is complete, 0 while it is being written
+#				time	8 bytes	double, time.time() the frame was written
+#				data	size bytes
+# Frame n is written to slot n % slots, so the writer never waits and the last slots-1 frames stay
+# readable while the next is written. Readers copy a frame then check its slot header is unchanged.
+
+import json
+import mmap
+import os
+import struct
+from collections import OrderedDict, deque
+
+SOCKET_NAME = '\0JWBCamPIGPIO.sock' # abstract unix socket served by the daemon
+
+FRAME_MAGIC = 0xA5
+PROTOCOL_VERSION = 1
+HEADER = struct.Struct('!BBBBII')
+MAX_PAYLOAD = 1024*1024
+
+FRAME_TEXT = 1 # command or plain text reply
+FRAME_JSON = 2 # JSON encoded reply
+FRAME_ERROR = 3 # error reply, payload is the error code ('invalid', 'busy', ...)
+FRAME_EVENT = 4 # JSON encoded event pushed to a subscription, request id of the subscribe command
+FRAME_WATCH = 5 # command as FRAME_TEXT, the move it queues is followed by a FRAME_EVENT with its request id when done
+
+errorReplies = ('invalid','busy')
+
+stepperStates = {0 : 'Disabled',
+				 1 : 'Stopped',
+				 2 : 'Accelerating',
+				 3 : 'Moving',
+				 4 : 'Decelerating',
+				 5 : 'Waiting'} # between the operations of a program
+
+STATUS_PATH = '/dev/shm/JWBCamPIGPIO.status'
+STATUS_SEQ = struct.Struct('=Q')
+STATUS_FIELDS = struct.Struct('=IBbHqqd')
+STATUS_SIZE = STATUS_SEQ.size + STATUS_FIELDS.size
+STATUS_ENABLED = 1
+STATUS_TARGET = 2
+
+FRAME_PATH = '/dev/shm/JWBCamImage.ring'
+FRAME_SLOTS = 4
+FRAME_SLOT_SIZE = 20*1024*1024 # the largest full resolution JPEG expected
+FRAME_RING = struct.Struct('=QII')
+FRAME_HEADER = struct.Struct('=QIBd')
+
+class ProtocolError(Exception):
+	def __init__(self,message):
+		self.message = message
+
+def isFramed(data):
+	return len(data) > 0 and data[0] == FRAME_MAGIC
+
+def packFrame(ftype, requestId, payload):
+	if isinstance(payload, str):
+		payload = payload.encode('utf-8')
+	return HEADER.pack(FRAME_MAGIC, PROTOCOL_VERSION, ftype, 0, requestId & 0xFFFFFFFF, len(payload)) + payload
+
+def packReply(requestId, reply):
+	# Frame a parseMessage reply, choosing the payload type from the reply value
+	if isinstance(reply, (dict, list)):
+		return packFrame(FRAME_JSON, requestId, json.dumps(reply))
+	reply = str(reply)
+	if reply in errorReplies:
+		return packFrame(FRAME_ERROR, requestId, reply)
+	return packFrame(FRAME_TEXT, requestId, reply)
+
+def encodeLegacy(reply):
+	# Unframed reply for clients speaking the original bare text protocol
+	if isinstance(reply, (dict, list)):
+		return json.dumps(reply).encode('utf-8')
+	return str(reply).encode('utf-8')
+
+def decodePayload(ftype, payload):
+	if ftype == FRAME_JSON:
+		return json.loads(payload.decode('utf-8'), object_pairs_hook=OrderedDict)
+	return payload.decode('utf-8')
+
+class FrameReader():
+	# Reassembles frames from a byte stream regardless of how the stream was split by recv
+	def __init__(self):
+		self.buffer = bytearray()
+		self.pending = deque() # frames read by recvFrame but not yet returned
+
+	def feed(self, data):
+		self.buffer.extend(data)
+		frames = []
+		while len(self.buffer) >= HEADER.size:
+			magic, version, ftype, flags, requestId, length = HEADER.unpack_from(self.buffer)
+			if magic != FRAME_MAGIC:
+				raise ProtocolError('bad frame magic')
+			if version != PROTOCOL_VERSION:
+				raise ProtocolError('unsupported protocol version ' + str(version))
+			if length > MAX_PAYLOAD:
+				raise ProtocolError('frame too large')
+			end = HEADER.size + length
+			if len(self.buffer) < end:
+				break
+			frames.append((ftype, requestId, bytes(self.buffer[HEADER.size:end])))
+			del self.buffer[:end]
+		return frames
+
+def recvFrame(sock, reader):
+	# Block until one complete frame has been read from sock, returns (type, request id, payload)
+	while not reader.pending:
+		chunk = sock.recv(4096)
+		if not chunk:
+			raise ConnectionError('JWBCamPIGPIO connection closed')
+		reader.pending.extend(reader.feed(chunk))
+	return reader.pending.popleft()
+
+class StatusBlock():
+	# Shared memory stepper status - written by JWBCamPIGPIO only (create=True), mapped read only by clients.
+	# The file is left in place when the daemon exits so clients stay mapped across daemon restarts
+	def __init__(self, path=STATUS_PATH, create=False):
+		if create:
+			fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+			try:
+				os.ftruncate(fd, STATUS_SIZE)
+				self.map = mmap.mmap(fd, STATUS_SIZE, access=mmap.ACCESS_WRITE)
+			finally:
+				os.close(fd)
+			self.seq = STATUS_SEQ.unpack_from(self.map)[0] + 1 & ~1 # carry on from the last daemon
+		else:
+			fd = os.open(path, os.O_RDONLY)
+			try:
+				self.map = mmap.mmap(fd, STATUS_SIZE, access=mmap.ACCESS_READ)
+			finally:
+				os.close(fd)
+			self.seq = None
+	
+	def write(self, pid, state, direction, flags, position, target, time):
+		self.seq += 1
+		STATUS_SEQ.pack_into(self.map, 0, self.seq)
+		STATUS_FIELDS.pack_into(self.map, STATUS_SEQ.size, pid, state, direction, flags, position, target, time)
+		self.seq += 1
+		STATUS_SEQ.pack_into(self.map, 0, self.seq)
+	
+	def read(self, tries=10000):
+		# Returns (sequence, pid, state, direction, flags, position, target, time) without system calls,
+		# None if no consistent copy was read in tries attempts (writer died mid update)
+		for ii in range(tries):
+			seq = STATUS_SEQ.unpack_from(self.map)[0]
+			if seq & 1:
+				continue
+			fields = STATUS_FIELDS.unpack_from(self.map, STATUS_SEQ.size)
+			if STATUS_SEQ.unpack_from(self.map)[0] == seq:
+				return (seq,) + fields
+		return None
+	
+	def close(self):
+		self.map.close()
+
+class FrameRing():
+	# Shared memory camera frames - written by JWBCamGphoto only (create=True), mapped read only by
+	# clients. The file is sparse, only the pages of frames actually written take memory
+	def __init__(self, path=FRAME_PATH, create=False, slots=FRAME_SLOTS, size=FRAME_SLOT_SIZE):
+		self.path = path
+		if create:
+			fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+			try:
+				os.ftruncate(fd, FRAME_RING.size + slots*(FRAME_HEADER.size + size))
+				self.map = mmap.mmap(fd, 0, access=mmap.ACCESS_WRITE)
+			finally:
+				os.close(fd)
+			self.latest = FRAME_RING.unpack_from(self.map)[0] # carry on from the last writer
+			FRAME_RING.pack_into(self.map, 0, self.latest, slots, size)
+			for slot in range(slots): # frames of an earlier writer are no longer valid
+				FRAME_HEADER.pack_into(self.map, FRAME_RING.size + slot*(FRAME_HEADER.size + size), 0, 0, 0, 0)
+		else:
+			fd = os.open(path, os.O_RDONLY)
+			try:
+				self.map = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+			finally:
+				os.close(fd)
+			latest, slots, size = FRAME_RING.unpack_from(self.map)
+		self.slots = slots
+		self.size = size
+	
+	def offset(self, seq):
+		return FRAME_RING.size + (seq % self.slots)*(FRAME_HEADER.size + self.size)
+	
+	def write(self, data, time):
+		# Store a frame in the next slot, returns its sequence number. Never waits for readers
+		if len(data) > self.size:
+			raise ValueError('frame of ' + str(len(data)) + ' bytes is larger than a slot')
+		seq = self.latest + 1
+		offset = self.offset(seq)
+		FRAME_HEADER.pack_into(self.map, offset, seq, 0, 0, 0) # not ready, readers of the old frame will retry
+		start = offset + FRAME_HEADER.size
+		self.map[start:start + len(data)] = data
+		FRAME_HEADER.pack_into(self.map, offset, seq, len(data), 1, time)
+		self.latest = seq
+		FRAME_RING.pack_into(self.map, 0, seq, self.slots, self.size)
+		return seq
+	
+	def read(self, seq=None, tries=100):
+		# Returns (seq, time, bytes) for frame seq, or the newest frame if seq is None. None if there is
+		# no frame yet, frame seq has been overwritten, or no complete copy was made in tries attempts
+		for ii in range(tries):
+			wanted = FRAME_RING.unpack_from(self.map)[0] if seq is None else seq
+			if not wanted:
+				return None
+			offset = self.offset(wanted)
+			header = FRAME_HEADER.unpack_from(self.map, offset)
+			slotSeq, length, ready, time = header
+			if slotSeq != wanted or not ready:
+				if seq is not None and slotSeq != wanted:
+					return None
+				continue
+			start = offset + FRAME_HEADER.size
+			data = self.map[start:start + length]
+			if FRAME_HEADER.unpack_from(self.map, offset) == header:
+				return slotSeq, time, data
+		return None
+	
+	def close(self):
+		self.map.close()
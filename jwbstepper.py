@@ -1,10 +1,21 @@
 #!/usr/bin/python3
 
+import os
 import socket
+import select
 import json
-from time import perf_counter as tic, sleep
-from threading import Thread, Event
+import asyncio
+from time import perf_counter as tic, time
+from threading import Thread, Event, Lock, BoundedSemaphore
+from queue import Queue, LifoQueue, Empty
 from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import Future
+from jwbprotocol import FrameReader, packFrame, recvFrame, decodePayload, FRAME_TEXT, FRAME_JSON, FRAME_EVENT, FRAME_WATCH
+from jwbprotocol import stepperStates, StatusBlock, STATUS_ENABLED, STATUS_TARGET, SOCKET_NAME
+
+socketName = SOCKET_NAME # daemon address, JWBCamBench points clients at its own socket
+statusStale = 5 # seconds without a status block write before the daemon is checked for, it rewrites every second
 
 class BusyError(Exception):
 	def __init__(self,message):
@@ -14,71 +25,432 @@ class ConnectionError(Exception):
 	def __init__(self,message):
 		self.message = message
 
+class Connection():
+	# One framed command connection to JWBCamPIGPIO, used by one caller at a time
+	def __init__(self, timeout=1):
+		self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		try:
+			self.sock.connect(socketName)
+		except OSError:
+			self.sock.close()
+			raise
+		self.sock.settimeout(timeout)
+		self.reader = FrameReader()
+		self.requestId = 0
+	
+	def command(self, command):
+		# Send one command and block for the reply with the matching request ID
+		self.requestId = (self.requestId + 1) & 0xFFFFFFFF
+		self.sock.sendall(packFrame(FRAME_TEXT, self.requestId, command))
+		ftype, requestId, payload = recvFrame(self.sock, self.reader)
+		while requestId != self.requestId: # reply to a request abandoned earlier
+			ftype, requestId, payload = recvFrame(self.sock, self.reader)
+		return decodePayload(ftype, payload)
+	
+	def commands(self, commands):
+		# Send commands back to back in one write, then collect their replies by request ID
+		frames = []
+		replies = OrderedDict()
+		for command in commands:
+			self.requestId = (self.requestId + 1) & 0xFFFFFFFF
+			frames.append(packFrame(FRAME_TEXT, self.requestId, command))
+			replies[self.requestId] = None
+		self.sock.sendall(b''.join(frames))
+		waiting = len(replies)
+		while waiting:
+			ftype, requestId, payload = recvFrame(self.sock, self.reader)
+			if requestId in replies and replies[requestId] is None:
+				replies[requestId] = (ftype, payload)
+				waiting -= 1
+		return [decodePayload(ftype, payload) for ftype, payload in replies.values()]
+	
+	def healthy(self):
+		# An idle connection has nothing to read, readable means the daemon closed it. select rather
+		# than poll, gevent's monkey patching removes poll
+		if self.reader.buffer or self.reader.pending:
+			return False
+		try:
+			return not select.select([self.sock], [], [], 0)[0]
+		except (OSError, ValueError):
+			return False
+	
+	def close(self):
+		self.sock.close()
+
+class ConnectionPool():
+	# Daemon connections leased to one command at a time, so threads and greenlets sharing a
+	# jwbstepper never read each other's replies. Idle connections are checked before reuse, a
+	# connection that fails mid command is dropped, and after a failed connect new connections are
+	# refused for a backoff doubling up to maxBackoff seconds
+	def __init__(self, size=4, leaseTimeout=5.0, maxBackoff=5.0):
+		self.size = size
+		self.leaseTimeout = leaseTimeout
+		self.maxBackoff = maxBackoff
+		self.slots = BoundedSemaphore(size)
+		self.idle = LifoQueue() # most recently used first, the others can time out and be dropped
+		self.backoff = 0
+		self.retryAt = 0
+		self.closed = False
+		self.opened = 0
+		self.dropped = 0
+		self.refused = 0
+	
+	@contextmanager
+	def lease(self):
+		if not self.slots.acquire(timeout=self.leaseTimeout):
+			raise ConnectionError('JWBCamPIGPIO connection pool exhausted')
+		try:
+			connection = self.take()
+			try:
+				yield connection
+			except Exception:
+				self.dropped += 1
+				connection.close()
+				raise
+			if self.closed:
+				connection.close()
+			else:
+				self.idle.put(connection)
+		finally:
+			self.slots.release()
+	
+	def take(self):
+		while True:
+			try:
+				connection = self.idle.get_nowait()
+			except Empty:
+				break
+			if connection.healthy():
+				return connection
+			self.dropped += 1
+			connection.close()
+		now = tic()
+		if now < self.retryAt:
+			self.refused += 1
+			raise ConnectionError('JWBCamPIGPIO not connected')
+		try:
+			connection = Connection()
+		except OSError:
+			self.backoff = min(self.backoff*2 or 0.05, self.maxBackoff)
+			self.retryAt = now + self.backoff
+			raise ConnectionError('JWBCamPIGPIO not connected')
+		self.backoff = 0
+		self.closed = False
+		self.opened += 1
+		return connection
+	
+	def retry(self):
+		# Allow an immediate connect attempt regardless of the backoff
+		self.retryAt = 0
+	
+	def close(self):
+		self.closed = True
+		while True:
+			try:
+				self.idle.get_nowait().close()
+			except Empty:
+				return
+	
+	def stats(self):
+		return OrderedDict((('size', self.size),
+							('idle', self.idle.qsize()),
+							('opened', self.opened),
+							('dropped', self.dropped),
+							('refused', self.refused),
+							('backoff', self.backoff)))
+
+class Pipeline():
+	# Commands queued in a with stepper.pipeline() block, sent back to back on one connection as the
+	# block exits - one round trip for all of them. results then holds each command's reply, or the
+	# BusyError or ValueError it failed with, in the order queued. Nothing is sent if the block raises
+	def __init__(self, settingNames, send, moveCommand, settingWritten, moved):
+		object.__setattr__(self, '_Pipeline__queued', []) # (command, setting name, value, is a move)
+		object.__setattr__(self, '_Pipeline__settingNames', settingNames)
+		object.__setattr__(self, '_Pipeline__send', send)
+		object.__setattr__(self, '_Pipeline__moveCommand', moveCommand)
+		object.__setattr__(self, '_Pipeline__settingWritten', settingWritten)
+		object.__setattr__(self, '_Pipeline__moved', moved)
+		object.__setattr__(self, 'results', None)
+	
+	def __enter__(self):
+		return self
+	
+	def __exit__(self, excType, excValue, traceback):
+		if excType is None:
+			self.execute()
+		return False
+	
+	def __setattr__(self, name, value):
+		if name not in self.__settingNames:
+			raise AttributeError(name)
+		self.set(name, value)
+	
+	def command(self, command):
+		self.__queued.append((command, None, None, False))
+	
+	def set(self, name, value):
+		if name not in self.__settingNames:
+			raise AttributeError(name)
+		self.__queued.append((name + str(value), name, value, False))
+	
+	def get(self, name):
+		self.command(name)
+	
+	def step(self, steps):
+		self.__queued.append((self.__moveCommand('step', steps), None, None, True))
+	
+	def stepTo(self, position):
+		self.__queued.append((self.__moveCommand('stepTo', position), None, None, True))
+	
+	def move(self, distance):
+		self.__queued.append((self.__moveCommand('move', distance), None, None, True))
+	
+	def moveTo(self, position):
+		self.__queued.append((self.__moveCommand('moveTo', position), None, None, True))
+	
+	def runfor(self, seconds=float('inf')):
+		self.__queued.append((self.__moveCommand('runfor', seconds), None, None, True))
+	
+	def enable(self):
+		self.command('enable')
+	
+	def disable(self):
+		self.command('disable')
+	
+	def stop(self):
+		self.command('stop')
+	
+	def getstate(self):
+		self.command('state')
+	
+	def execute(self):
+		# Send everything queued so far, returns and stores the results. Raises ConnectionError only
+		# if the connection fails, then none of the results are known
+		queued = self.__queued
+		object.__setattr__(self, '_Pipeline__queued', [])
+		replies = self.__send([command for command, name, value, moving in queued]) if queued else []
+		results = []
+		for (command, name, value, moving), reply in zip(queued, replies):
+			if reply == 'busy':
+				reply = BusyError('busy')
+			elif reply == 'invalid':
+				reply = ValueError((str(value) + ' is invalid for ' + name) if name else 'invalid command ' + command)
+			elif name:
+				self.__settingWritten(name, value)
+			elif moving:
+				self.__moved()
+			results.append(reply)
+		object.__setattr__(self, 'results', results)
+		return results
+
+class MoveFuture(Future):
+	# End of a move sent without waiting, resolved with the daemon's move event - op, completed (False
+	# if stopped or flushed), position, started and finished. Await it from asyncio, call result()
+	# from threads or from greenlets once gevent has patched threading, or wait on gevent()
+	def __await__(self):
+		return asyncio.wrap_future(self).__await__()
+	
+	def gevent(self):
+		# gevent.event.AsyncResult resolved in the calling greenlet's hub, gevent is only imported here
+		import gevent
+		from gevent.event import AsyncResult
+		result = AsyncResult()
+		hub = gevent.get_hub()
+		def resolve(future):
+			if future.exception() is not None:
+				hub.loop.run_callback_threadsafe(result.set_exception, future.exception())
+			else:
+				hub.loop.run_callback_threadsafe(result.set, future.result())
+		self.add_done_callback(resolve)
+		return result
+
+class MoveWatcher():
+	# Connection for moves sent without waiting. Each goes as a FRAME_WATCH command and its MoveFuture
+	# is resolved by the listener thread - failed by a busy or invalid reply, or set by the event
+	# the daemon tags with the command's request ID when the move ends
+	def __init__(self):
+		self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		try:
+			self.sock.connect(socketName)
+		except OSError:
+			self.sock.close()
+			raise ConnectionError('JWBCamPIGPIO not connected')
+		self.reader = FrameReader()
+		self.lock = Lock()
+		self.requestId = 0
+		self.pending = {} # request ID : MoveFuture
+		self.listener = Thread(target=self.__listen, daemon=True)
+		self.listener.start()
+	
+	def submit(self, command):
+		future = MoveFuture()
+		with self.lock:
+			self.requestId = (self.requestId + 1) & 0xFFFFFFFF
+			self.pending[self.requestId] = future
+			try:
+				self.sock.sendall(packFrame(FRAME_WATCH, self.requestId, command))
+			except OSError:
+				del self.pending[self.requestId]
+				raise ConnectionError('JWBCamPIGPIO not connected')
+		return future
+	
+	def __listen(self):
+		try:
+			while True:
+				ftype, requestId, payload = recvFrame(self.sock, self.reader)
+				if ftype == FRAME_EVENT:
+					future = self.pending.pop(requestId, None)
+					if future:
+						future.set_result(decodePayload(FRAME_JSON, payload))
+					continue
+				reply = decodePayload(ftype, payload)
+				if reply in ('busy', 'invalid'):
+					future = self.pending.pop(requestId, None)
+					if future:
+						future.set_exception(BusyError('busy') if reply == 'busy' else ValueError('invalid move'))
+		except Exception:
+			pass
+		finally:
+			with self.lock:
+				pending, self.pending = self.pending, {}
+			for future in pending.values():
+				future.set_exception(ConnectionError('JWBCamPIGPIO connection closed'))
+	
+	def close(self):
+		try:
+			self.sock.shutdown(socket.SHUT_RDWR)
+		except OSError:
+			pass
+		self.sock.close()
+
+class Subscription():
+	# Status events pushed by JWBCamPIGPIO over a dedicated connection. Each event is a dict of the
+	# settings that changed plus 'State' and 'time', or a notification with an 'event' key ('frame'
+	# as each scan frame fires, 'scan' when a scan ends). Events go to callback if given, otherwise
+	# iterate over the subscription to receive them.
+	def __init__(self, callback=None, interval=0.1):
+		self.callback = callback
+		self.events = Queue()
+		self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		try:
+			self.sock.connect(socketName)
+			self.sock.settimeout(1)
+			self.sock.sendall(packFrame(FRAME_TEXT, 1, 'subscribe' + str(interval)))
+			self.reader = FrameReader()
+			ftype, requestId, payload = recvFrame(self.sock, self.reader)
+		except Exception:
+			self.sock.close()
+			raise ConnectionError('JWBCamPIGPIO not connected')
+		if decodePayload(ftype, payload) != 'success':
+			self.sock.close()
+			raise ConnectionError('JWBCamPIGPIO subscription refused')
+		self.sock.settimeout(None)
+		self.listener = Thread(target=self.__listen, daemon=True)
+		self.listener.start()
+	
+	def __listen(self):
+		try:
+			while True:
+				ftype, requestId, payload = recvFrame(self.sock, self.reader)
+				if ftype != FRAME_EVENT:
+					continue
+				event = decodePayload(FRAME_JSON, payload)
+				if self.callback:
+					self.callback(event)
+				else:
+					self.events.put(event)
+		except Exception:
+			pass
+		finally:
+			self.events.put(None)
+	
+	def __iter__(self):
+		event = self.events.get()
+		while event is not None:
+			yield event
+			event = self.events.get()
+	
+	def close(self):
+		try:
+			self.sock.shutdown(socket.SHUT_RDWR)
+		except OSError:
+			pass
+		self.sock.close()
+
 class jwbstepper():
 	commandList = {'connect'			:'none',
 					'close'				:'none',
 					'is_connected'		:'none',
+					'connections'		:'none',
+					'cacheStats'		:'none',
 					'enable'			:'none',
 					'disable'			:'none',
 					'stop'				:'none',
 					'hardstop'			:'none',
+					'estop'				:'none',
 					'getstate'			:'none',
+					'status'			:'none',
+					'wavePool'			:'none',
+					'stats'				:'none',
 					'step'				:'steps=(+/-)int',
 					'stepTo'			:'position=(+/-)int',
 					'move'				:'distance=(+/-)float',
 					'moveTo'			:'position=(+/-)float',
 					'runfor'			:'seconds=(+)float',
+					'program'			:'operations=[{op:step|stepTo|move|moveTo|run|dwell|wait, ...}]',
+					'pipeline'			:'none, use as with stepper.pipeline() as p',
+					'stepAsync'			:'steps=(+/-)int, returns MoveFuture',
+					'stepToAsync'		:'position=(+/-)int, returns MoveFuture',
+					'moveAsync'			:'distance=(+/-)float, returns MoveFuture',
+					'moveToAsync'		:'position=(+/-)float, returns MoveFuture',
+					'runforAsync'		:'seconds=(+)float, returns MoveFuture',
+					'idle'				:'none, returns MoveFuture',
+					'programStatus'		:'none',
+					'estimate_move'		:'op=step|stepTo|move|moveTo|runfor, value=(+/-)float',
+					'scan'				:'frames=(+)int, end=(+/-)int, start=(+/-)int, velocity=(+)float, pin=Shutter|Focus|None, width=(+)int',
+					'scanStatus'		:'none',
+					'trigger'			:'pin=Shutter|Focus, step=(+)int | after=(+)int | delay=(+)int, width=(+)int',
+					'triggers'			:'none',
+					'clearTriggers'		:'none',
+					'signal'			:'name=string',
 					'kill'				:'none',
 					'settings'			:'none',
+					'subscribe'			:'callback=function(dict), interval=(+)float',
 					'settingsList'		:'none',
 					'commands'			:'none',
 					'commandsList'		:'none'}
 
-	def __init__(self):
-		self.__sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-		try:
-			self.__sock.connect('\0JWBCamPIGPIO.sock')
-		except Exception as e:
-			print(e)
-			self.__sock = None
-			self.__connected = False
-			self.__settings = {}
-		else:
-			try:
-				self.__sock.settimeout(0.1)
-				self.__sock.send(b'settings')
-				encoded = self.__sock.recv(1024)
-			except Exception as e:
-				print(e)
-				self.__sock.close()
-				self.__sock = None
-				self.__connected = False
-				self.__settings = {}
-			else:
-				self.__connected = True
-				self.__settings = json.loads(encoded.decode('utf-8'), object_pairs_hook=OrderedDict)
-				self.__lastUpdate = tic()
-				self.__newMove = Event()
-				self.__poller = Thread(target = jwbstepper.__pollSettings, args=(self,))
-				self.__poller.start()
+	def __init__(self, poolSize=4, cacheTTL=0.5):
+		self.__pool = ConnectionPool(poolSize) # one connection per concurrent command
+		self.__connected = False
+		self.__lastUpdate = None
+		self.__newMove = Event()
+		self.__status = None # shared memory status block, mapped on connect
+		self.__cacheTTL = cacheTTL
+		self.__cacheExpiry = 0 # setting reads are served from __settings until then
+		self.__cacheStats = OrderedDict((('hits', 0), ('misses', 0), ('notifications', 0), ('invalidations', 0)))
+		self.__notifier = None # subscription keeping __settings current with changes made by any client
+		self.__watcher = None # connection for moves sent without waiting, opened on first use
+		self.__watcherLock = Lock()
+		self.__settings = {}
+		self.__estimates = {} # estimate_move replies keyed by command, settings and start position
+		self.connect()
 	
 	def __getattr__(self, name):
+		if name in ('Stepper_Position', 'Direction') and self.__connected:
+			status = self.status()
+			if status:
+				return status[name]
 		if name in self.__settings:
-			if self.__connected:
-				try:
-					self.__sock.send(name.encode('utf-8'))
-					val = self.__sock.recv(1024)
-					if not val:
-						self.__sock.close()
-						self.__sock = None
-						self.__connected = False
-						val = self.__settings[name]
-					else:
-						val = val.decode('utf-8')
-				except:
-					val = self.__settings[name]
-				return val
-			else:
+			try:
+				if name == 'Stepper_Position': # changes too often to cache
+					return int(self.__command(name))
+				if tic() < self.__cacheExpiry:
+					self.__cacheStats['hits'] += 1
+					return self.__settings[name]
+				self.__cacheStats['misses'] += 1
+				return self.__refreshSettings()[name]
+			except (ConnectionError, KeyError): # last known value while the daemon is unreachable
 				return self.__settings[name]
 		else:
 			raise AttributeError(name)
@@ -87,308 +459,397 @@ class jwbstepper():
 		if not '_jwbstepper__settings' in self.__dict__: # Only true before __settings dict is initialized
 			return object.__setattr__(self, name, value)
 		if name in self.__settings: # If the attribute is found in the settings dict, attempt sending the new value to the GPIO process
-			if not self.__connected: # Not connected, cannot set attribute - raise AttributeError - Settings are read-only once connection is lost
-				raise AttributeError(name)
-			msg = name + str(value)
 			try: # Try sending message to change setting
-				self.__sock.send(msg.encode('utf-8'))
-				encoded = self.__sock.recv(1024)
-			except: # Send or receive failure implies connection failure - raise AttributeError - Settings are read-only once connection is lost
-				self.__sock.close()
-				self.__sock = None
-				self.__connected = False
+				reply = self.__command(name + str(value))
+			except ConnectionError: # Send or receive failure implies connection failure - raise AttributeError - Settings are read-only once connection is lost
 				raise AttributeError(name)
 			else: # Communication was successful, check for invalid message - raise ValueError if setting invalid
-				if encoded == b'invalid':
+				if reply == 'invalid':
 					raise ValueError(str(value) + ' is invalid for ' + name)
-				if encoded == b'busy':
+				if reply == 'busy':
 					raise BusyError('busy')
-				self.__settings[name] = value # Complete success, store new value locally
+				self.__settingWritten(name, value) # Complete success, store new value locally
 		else: # Attribute isn't a current setting, treat normally
 			return object.__setattr__(self, name, value)
 	
+	def __command(self, command):
+		# Send one framed command on a leased connection, reconnecting if the daemon has restarted
+		try:
+			with self.__pool.lease() as connection:
+				reply = connection.command(command)
+		except ConnectionError:
+			self.__connected = False
+			raise
+		except Exception:
+			self.__connected = False
+			raise ConnectionError('JWBCamPIGPIO not connected')
+		self.__connected = True
+		return reply
+	
+	def __pipelined(self, commands):
+		# Send commands back to back on one leased connection, returns their replies in order
+		try:
+			with self.__pool.lease() as connection:
+				replies = connection.commands(commands)
+		except ConnectionError:
+			self.__connected = False
+			raise
+		except Exception:
+			self.__connected = False
+			raise ConnectionError('JWBCamPIGPIO not connected')
+		self.__connected = True
+		return replies
+	
+	def __settingWritten(self, name, value):
+		# Store a value the daemon accepted and read back its values, other settings may follow from it
+		self.__settings[name] = value
+		self.__cacheExpiry = 0
+		self.__cacheStats['invalidations'] += 1
+	
+	def __refreshSettings(self):
+		# Fetch every setting in one round trip and serve reads from them for cacheTTL seconds
+		settings = self.__command('settings')
+		self.__settings = settings
+		self.__cacheExpiry = tic() + self.__cacheTTL
+		if self.__notifier is None or not self.__notifier.listener.is_alive(): # first use or daemon restarted
+			try:
+				self.__notifier = Subscription(self.__notified, 0.05)
+			except ConnectionError:
+				self.__notifier = None
+		return settings
+	
+	def __notified(self, event):
+		# Status event from the daemon, carries the new value of every setting changed by any client
+		if 'event' in event:
+			return
+		settings = self.__settings
+		for name, value in event.items():
+			if name in settings:
+				settings[name] = value
+		self.__cacheStats['notifications'] += 1
+	
+	def __watch(self, command):
+		# Send a command on the watcher connection, returns its MoveFuture
+		with self.__watcherLock:
+			if self.__watcher is None or not self.__watcher.listener.is_alive():
+				try:
+					self.__watcher = MoveWatcher()
+				except ConnectionError:
+					self.__connected = False
+					raise
+			future = self.__watcher.submit(command)
+		self.__newMove.set()
+		return future
+	
+	def __moveCommand(self, op, value):
+		# Command text for a move, ValueError if value is not a number of the kind op takes
+		kind = int if op in ('step', 'stepTo') else float
+		try:
+			kind(str(value))
+		except ValueError:
+			raise ValueError(('steps' if op == 'step' else 'position' if op.endswith('To') else
+							  'distance' if op == 'move' else 'seconds') + ' must be a number of the right kind')
+		return ('run' if op == 'runfor' else op) + str(value)
+	
 	def __pollSettings(stepper):
 		while stepper.__lastUpdate:
-			if stepper.__newMove.wait(0.01):
+			if stepper.__newMove.wait() and stepper.__lastUpdate: # set by moves, and by close to exit
 				try:
-					stepper.__sock.send(b'settings')
-					encoded = stepper.__sock.recv(1024)
-				except Exception as e:
-					stepper.__connected = False
-					stepper.__sock.close()
-					stepper.__sock = None
-					
+					stepper.__refreshSettings()
+				except ConnectionError:
 					stepper.__settings = {}
 				else:
-					stepper.__settings = json.loads(encoded.decode('utf-8'), object_pairs_hook=OrderedDict)
 					return stepper.__settings
 	
 	def connect(self):
 		if self.__connected:
 			return True
-		self.__sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		self.__pool.retry()
+		if self.__status is None:
+			try:
+				self.__status = StatusBlock()
+			except OSError: # daemon without a status block, status comes over the socket
+				self.__status = None
 		try:
-			self.__sock.connect('\0JWBCamPIGPIO.sock')
-		except:
-			self.__sock = None
-			self.__connected = False
+			self.__refreshSettings()
+		except ConnectionError as e:
+			print(e.message)
 			self.__settings = {}
 			return False
-		else:
-			try:
-				self.__sock.send(b'settings')
-				encoded = self.__sock.recv(1024)
-			except:
-				self.__sock.close()
-				self.__sock = None
-				self.__connected = False
-				self.__settings = {}
-				return False
-			else:
-				self.__connected = True
-				self.__settings = {}
-				settings = json.loads(encoded.decode('utf-8'))
-				for setting in settings:
-					if hasattr(self,setting):
-						delattr(self,setting)
-				self.__settings = settings
-				self.__lastUpdate = tic()
-				self.__newMove.clear()
-				self.__poller = Thread(target=__pollSettings, args=(self,))
-				self.__poller.start()
-				return True
+		self.__lastUpdate = tic()
+		self.__newMove.clear()
+		self.__poller = Thread(target=jwbstepper.__pollSettings, args=(self,))
+		self.__poller.start()
+		return True
 	
 	def close(self):
 		self.__lastUpdate = None
 		self.__newMove.set()
 		self.__poller.join(1)
 		del self.__poller
-		self.__sock.close()
-		self.__sock = None
+		if self.__notifier:
+			self.__notifier.close()
+			self.__notifier = None
+		if self.__watcher:
+			self.__watcher.close()
+			self.__watcher = None
+		self.__pool.close()
 		self.__connected = False
 	
 	def is_connected(self):
 		return self.__connected
 	
+	def cacheStats(self):
+		# Setting reads served from the cache and from the daemon, status events applied to the cache
+		# and local writes that expired it
+		stats = OrderedDict(self.__cacheStats)
+		stats['ttl'] = self.__cacheTTL
+		stats['notifying'] = bool(self.__notifier and self.__notifier.listener.is_alive())
+		return stats
+	
+	def connections(self):
+		# Connection pool occupancy and reconnect counters
+		return self.__pool.stats()
+	
 	def enable(self):
-		if self.__connected:
-			try:
-				self.__sock.send(b'enable')
-				encoded = self.__sock.recv(1024)
-			except:
-				self.__sock.close()
-				self.__sock = None
-				self.__connected = False
-				raise ConnectionError('JWBCamPIGPIO not connected')
-		else:
-			raise ConnectionError('JWBCamPIGPIO not connected')
+		self.__command('enable')
 	
 	def disable(self):
-		if self.__connected:
-			try:
-				self.__sock.send(b'disable')
-				encoded = self.__sock.recv(1024)
-			except:
-				self.__sock.close()
-				self.__sock = None
-				self.__connected = False
-				raise ConnectionError('JWBCamPIGPIO not connected')
-		else:
-			raise ConnectionError('JWBCamPIGPIO not connected')
+		self.__command('disable')
 	
 	def stop(self):
-		if self.__connected:
-			try:
-				self.__sock.send(b'stop')
-				encoded = self.__sock.recv(1024)
-			except:
-				self.__sock.close()
-				self.__sock = None
-				self.__connected = False
-				raise ConnectionError('JWBCamPIGPIO not connected')
-		else:
-			raise ConnectionError('JWBCamPIGPIO not connected')
+		self.__command('stop')
 	
 	def hardstop(self):
-		if self.__connected:
-			try:
-				self.__sock.send(b'hard')
-				encoded = self.__sock.recv(1024)
-			except:
-				self.__sock.close()
-				self.__sock = None
-				self.__connected = False
-				raise ConnectionError('JWBCamPIGPIO not connected')
-		else:
-			raise ConnectionError('JWBCamPIGPIO not connected')
+		self.__command('hard')
+	
+	def estop(self):
+		# Halts step pulses immediately, returns the daemon's report of the stop position and latency
+		return self.__command('estop')
 	
 	def flipDir(self):
-		if self.__connected:
-			try:
-				self.__sock.send(b'flipdir')
-				encoded = self.__sock.recv(1024)
-			except:
-				self.__sock.close()
-				self.__sock = None
-				self.__connected = False
-				raise ConnectionError('JWBCamPIGPIO not connected')
-		else:
-			raise ConnectionError('JWBCamPIGPIO not connected')
+		self.__command('flipdir')
 	
 	def getstate(self):
-		if self.__connected:
+		status = self.status() if self.__connected else None
+		if status:
+			return status['State']
+		return self.__command('state')
+	
+	def status(self):
+		# Position, state, direction and move target read from shared memory without a round trip
+		# to the daemon, None if the status block is unavailable or the daemon has exited
+		fields = self.__status.read() if self.__status else None
+		if not fields or not fields[1]:
+			return None
+		seq, pid, state, direction, flags, position, target, written = fields
+		if time() - written > statusStale: # a killed daemon leaves its last status behind
 			try:
-				self.__sock.send(b'state')
-				encoded = self.__sock.recv(1024)
-			except:
-				self.__sock.close()
-				self.__sock = None
-				self.__connected = False
-				raise ConnectionError('JWBCamPIGPIO not connected')
-			else:
-				return encoded.decode('utf-8')
-		else:
-			raise ConnectionError('JWBCamPIGPIO not connected')
+				os.kill(pid, 0)
+			except ProcessLookupError:
+				return None
+			except PermissionError: # running as another user
+				pass
+		return OrderedDict((('State', stepperStates.get(state, 'Unknown')),
+							('Stepper_Position', position),
+							('Direction', 'CW' if direction > 0 else 'CCW'),
+							('Enabled', bool(flags & STATUS_ENABLED)),
+							('Target', target if flags & STATUS_TARGET else None),
+							('sequence', seq),
+							('time', written)))
+	
+	def wavePool(self):
+		return self.__command('wavepool')
+	
+	def stats(self):
+		return self.__command('stats')
 	
 	def step(self, steps):
-		if self.__connected:
-			try:
-				steps = str(steps)
-				test = int(steps)
-			except:
-				raise ValueError('steps must be an int or string representation of an int')
-			try:
-				msg = 'step' + steps
-				self.__sock.send(msg.encode('utf-8'))
-				encoded = self.__sock.recv(1024)
-			except:
-				self.__sock.close()
-				self.__sock = None
-				self.__connected = False
-				raise ConnectionError('JWBCamPIGPIO not connected')
-			else:
-				if encoded == b'busy':
-					raise BusyError('busy')
-				self.__newMove.set()
-				return encoded.decode('utf-8')
-		else:
-			raise ConnectionError('JWBCamPIGPIO not connected')
+		try:
+			steps = str(steps)
+			test = int(steps)
+		except:
+			raise ValueError('steps must be an int or string representation of an int')
+		reply = self.__command('step' + steps)
+		if reply == 'busy':
+			raise BusyError('busy')
+		self.__newMove.set()
+		return reply
 
 	def stepTo(self, position):
-		if self.__connected:
-			try:
-				position = str(position)
-				test = int(position)
-			except:
-				raise ValueError('position must be an int or string representation of an int')
-			try:
-				msg = 'stepTo' + position
-				self.__sock.send(msg.encode('utf-8'))
-				encoded = self.__sock.recv(1024)
-			except:
-				self.__sock.close()
-				self.__sock = None
-				self.__connected = False
-				raise ConnectionError('JWBCamPIGPIO not connected')
-			else:
-				if encoded == b'busy':
-					raise BusyError('busy')
-				self.__newMove.set()
-				return encoded.decode('utf-8')
-		else:
-			raise ConnectionError('JWBCamPIGPIO not connected')
+		try:
+			position = str(position)
+			test = int(position)
+		except:
+			raise ValueError('position must be an int or string representation of an int')
+		reply = self.__command('stepTo' + position)
+		if reply == 'busy':
+			raise BusyError('busy')
+		self.__newMove.set()
+		return reply
 	
 	def move(self, distance):
-		if self.__connected:
-			try:
-				distance = str(distance)
-				test = float(distance)
-			except:
-				raise ValueError('distance must be numerical or a string representation of a number')
-			try:
-				msg = 'move' + distance
-				self.__sock.send(msg.encode('utf-8'))
-				encoded = self.__sock.recv(1024)
-			except:
-				self.__sock.close()
-				self.__sock = None
-				self.__connected = False
-				raise ConnectionError('JWBCamPIGPIO not connected')
-			else:
-				if encoded == b'busy':
-					raise BusyError('busy')
-				self.__newMove.set()
-				return encoded.decode('utf-8')
-		else:
-			raise ConnectionError('JWBCamPIGPIO not connected')
+		try:
+			distance = str(distance)
+			test = float(distance)
+		except:
+			raise ValueError('distance must be numerical or a string representation of a number')
+		reply = self.__command('move' + distance)
+		if reply == 'busy':
+			raise BusyError('busy')
+		self.__newMove.set()
+		return reply
 	
 	def moveTo(self,position):
-		if self.__connected:
-			try:
-				position = str(position)
-				test = float(position)
-			except:
-				raise ValueError('position must be a float or string representation of a float')
-			try:
-				msg = 'moveTo' + position
-				self.__sock.send(msg.encode('utf-8'))
-				encoded = self.__sock.recv(1024)
-			except:
-				self.__sock.close()
-				self.__sock = None
-				self.__connected = False
-				raise ConnectionError('JWBCamPIGPIO not connected')
-			else:
-				if encoded == b'busy':
-					raise BusyError('busy')
-				self.__newMove.set()
-				return encoded.decode('utf-8')
-		else:
-			raise ConnectionError('JWBCamPIGPIO not connected')
+		try:
+			position = str(position)
+			test = float(position)
+		except:
+			raise ValueError('position must be a float or string representation of a float')
+		reply = self.__command('moveTo' + position)
+		if reply == 'busy':
+			raise BusyError('busy')
+		self.__newMove.set()
+		return reply
 	
 	def runfor(self,seconds = float('inf')):
-		if self.__connected:
-			try:
-				seconds = str(seconds)
-				test = float(seconds)
-			except:
-				raise ValueError('seconds must be numerical or a string representation of a number')
-			try:
-				msg = 'run' + seconds
-				self.__sock.send(msg.encode('utf-8'))
-				encoded = self.__sock.recv(1024)
-			except:
-				self.__sock.close()
-				self.__sock = None
-				self.__connected = False
-				raise ConnectionError('JWBCamPIGPIO not connected')
-			else:
-				if encoded == b'busy':
-					raise BusyError('busy')
-				self.__newMove.set()
-				return encoded.decode('utf-8')
-		else:
+		try:
+			seconds = str(seconds)
+			test = float(seconds)
+		except:
+			raise ValueError('seconds must be numerical or a string representation of a number')
+		reply = self.__command('run' + seconds)
+		if reply == 'busy':
+			raise BusyError('busy')
+		self.__newMove.set()
+		return reply
+	
+	def pipeline(self):
+		# with stepper.pipeline() as p: queue commands on p, sent in one round trip as the block exits
+		return Pipeline(tuple(self.__settings), self.__pipelined, self.__moveCommand,
+						self.__settingWritten, self.__newMove.set)
+	
+	def stepAsync(self, steps):
+		# As step, without waiting - returns a MoveFuture resolved when the move ends
+		return self.__watch(self.__moveCommand('step', steps))
+	
+	def stepToAsync(self, position):
+		return self.__watch(self.__moveCommand('stepTo', position))
+	
+	def moveAsync(self, distance):
+		return self.__watch(self.__moveCommand('move', distance))
+	
+	def moveToAsync(self, position):
+		return self.__watch(self.__moveCommand('moveTo', position))
+	
+	def runforAsync(self, seconds=float('inf')):
+		return self.__watch(self.__moveCommand('runfor', seconds))
+	
+	def idle(self):
+		# MoveFuture resolved once every move queued so far has ended
+		return self.__watch('waitidle')
+	
+	def program(self, operations):
+		try:
+			msg = 'program' + json.dumps(operations)
+		except:
+			raise ValueError('operations must be a JSON serializable list of operation dicts')
+		reply = self.__command(msg)
+		if reply == 'busy':
+			raise BusyError('busy')
+		if reply == 'invalid':
+			raise ValueError('invalid program')
+		self.__newMove.set()
+		return reply
+	
+	def estimate_move(self, op, value):
+		# Duration of a move without running it, planned by the daemon from the current settings exactly
+		# as the move would be. Repeat queries for the same move and settings are answered locally
+		if op not in ('step', 'stepTo', 'move', 'moveTo', 'runfor'):
+			raise ValueError('op must be step, stepTo, move, moveTo or runfor')
+		try:
+			value = float(value)
+		except (TypeError, ValueError):
+			raise ValueError('value must be numerical or a string representation of a number')
+		command = 'estimate' + ('run' if op == 'runfor' else op) + str(value)
+		key = (command,) + tuple(self.__settings.get(name) for name in ('Velocity', 'Acceleration', 'Deceleration',
+								 'Microstep', 'Base_Step_Angle', 'Profile', 'Jerk'))
+		if op in ('stepTo', 'moveTo'):
+			key += (self.Stepper_Position,)
+		estimate = self.__estimates.get(key)
+		if estimate is None:
+			estimate = self.__command(command)
+			if estimate == 'invalid':
+				raise ValueError('invalid move')
+			if len(self.__estimates) >= 1024:
+				self.__estimates.clear()
+			self.__estimates[key] = estimate
+		return estimate
+	
+	def programStatus(self):
+		return self.__command('programstatus')
+	
+	def scan(self, frames, end, start=None, velocity=None, pin='default', width=None):
+		# Continuous scan - capture frames evenly spaced from start (or as soon as the motor is up to
+		# speed) to end, step positions, while moving at a constant velocity. Frames fire on the
+		# Shutter line unless pin is given, None for frame events only
+		spec = OrderedDict((('frames', frames), ('end', end)))
+		for key, value in (('start', start), ('velocity', velocity), ('width', width)):
+			if value is not None:
+				spec[key] = value
+		if pin != 'default':
+			spec['pin'] = pin
+		reply = self.__command('scan' + json.dumps(spec))
+		if reply == 'busy':
+			raise BusyError('busy')
+		if reply == 'invalid':
+			raise ValueError('invalid scan')
+		self.__newMove.set()
+		return reply
+	
+	def scanStatus(self):
+		# Position and time of every frame fired by the last scan
+		return self.__command('scanstatus')
+	
+	def trigger(self, pin='Shutter', step=None, after=None, delay=None, width=None):
+		# Pulses a camera trigger line, timed in microseconds by the step wave. With step or after the
+		# pulse is armed for the next move, at that step of it or after it ends, otherwise it fires
+		# delay microseconds from now once queued moves have finished
+		spec = OrderedDict([('pin', pin)])
+		for key, value in (('step', step), ('after', after), ('delay', delay), ('width', width)):
+			if value is not None:
+				spec[key] = value
+		reply = self.__command('trigger' + json.dumps(spec))
+		if reply == 'busy':
+			raise BusyError('busy')
+		if reply == 'invalid':
+			raise ValueError('invalid trigger - pin must be a connected Shutter or Focus line and times positive ints')
+		return reply
+	
+	def triggers(self):
+		# Trigger pulses armed for the next move
+		return self.__command('trigger')
+	
+	def clearTriggers(self):
+		return self.__command('trigger[]')
+	
+	def signal(self, name):
+		return self.__command('signal' + str(name))
+	
+	def subscribe(self, callback=None, interval=0.1):
+		if not self.__connected:
 			raise ConnectionError('JWBCamPIGPIO not connected')
+		return Subscription(callback, interval)
 	
 	def stopAndWait(self):
 		if not self.__connected:
 			raise ConnectionError('JWBCamPIGPIO not connected')
 		if not self.getstate() in ('Disabled','Stopped'):
 			self.stop()
-		while not self.getstate() in ('Disabled','Stopped'):
-			sleep(0.025)
+		self.idle().result()
 	
 	def kill(self):
-		if self.__connected:
-			try:
-				self.__sock.send(b'terminate')
-			except:
-				self.__sock.close()
-				self.__sock = None
-				self.__connected = False
-				raise ConnectionError('JWBCamPIGPIO not connected')
-		else:
-			raise ConnectionError('JWBCamPIGPIO not connected')
+		self.__command('terminate')
 	
 	def settings(self):
 		for setting in self.__settings:
@@ -400,18 +861,16 @@ class jwbstepper():
 	def settingsVals(self):
 		if not self.__connected:
 			return self.__settings
+		if tic() < self.__cacheExpiry:
+			self.__cacheStats['hits'] += 1
+			return self.__settings
+		self.__cacheStats['misses'] += 1
 		try:
-			self.__sock.send(b'settings')
-			encoded = self.__sock.recv(1024)
-		except Exception as e:
-			print(e)
-			self.__sock.close()
-			self.__sock = None
-			self.__connected = False
+			self.__refreshSettings()
+		except ConnectionError as e:
+			print(e.message)
 			self.__settings = {}
-		else:
-			self.__settings = json.loads(encoded.decode('utf-8'), object_pairs_hook=OrderedDict)
-			return self.__settings
+		return self.__settings
 	
 	def commands(self):
 		for command in self.commandList:
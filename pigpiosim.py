@@ -0,0 +1,319 @@
+#!/usr/bin/python3
+
+# In-process simulation of the pigpio python module for running JWBCamPIGPIO without a Pi
+#
+# Implements the subset of pigpio.pi used by JWBCamPIGPIO. Waves are held in memory and "transmitted"
+# against the wall clock, so wave_tx_at / wave_tx_busy follow the real timing of the pulses sent.
+# Resource limits follow the pigpiod defaults (pulses, control blocks, wave ids) and the same errors
+# are raised when they are exceeded. Every call sleeps for callLatency seconds to stand in for the
+# pigpiod socket round trip and is counted in callCounts.
+#
+# Select it in JWBCamPIGPIO with --simulate or JWBCAM_PIGPIO=sim in the environment.
+
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+INPUT = 0
+OUTPUT = 1
+
+WAVE_MODE_ONE_SHOT = 0
+WAVE_MODE_REPEAT = 1
+WAVE_MODE_ONE_SHOT_SYNC = 2
+WAVE_MODE_REPEAT_SYNC = 3
+
+WAVE_NOT_FOUND = 9998
+NO_TX_WAVE = 9999
+
+PI_SCRIPT_INITING = 0
+PI_SCRIPT_HALTED = 1
+PI_SCRIPT_RUNNING = 2
+PI_SCRIPT_WAITING = 3
+PI_SCRIPT_FAILED = 4
+
+PI_BAD_GPIO = -3
+PI_BAD_LEVEL = -5
+PI_BAD_MODE = -4
+PI_BAD_WAVE_MODE = -33
+PI_BAD_SCRIPT = -47
+PI_BAD_SCRIPT_ID = -48
+PI_TOO_MANY_PULSES = -36
+PI_BAD_WAVE_ID = -66
+PI_TOO_MANY_CBS = -67
+PI_EMPTY_WAVEFORM = -69
+PI_NO_WAVEFORM_ID = -70
+
+errorText = {
+	PI_BAD_GPIO:'GPIO not 0-53',
+	PI_BAD_LEVEL:'level not 0-1',
+	PI_BAD_MODE:'mode not 0-7',
+	PI_BAD_WAVE_MODE:'waveform mode not 0-3',
+	PI_BAD_SCRIPT:'invalid script',
+	PI_BAD_SCRIPT_ID:'unknown script id',
+	PI_TOO_MANY_PULSES:'waveform has too many pulses',
+	PI_BAD_WAVE_ID:'non existent wave id',
+	PI_TOO_MANY_CBS:'No more CBs for waveform',
+	PI_EMPTY_WAVEFORM:'attempt to create an empty waveform',
+	PI_NO_WAVEFORM_ID:'no more waveform ids',
+	}
+
+MAX_PULSES = 12000
+MAX_CBS = 25016
+MAX_WAVES = 250
+MAX_SCRIPTS = 32
+
+class error(Exception):
+	def __init__(self, value):
+		self.value = value
+
+	def __str__(self):
+		return repr(self.value)
+
+def raiseError(code):
+	raise error("'" + errorText.get(code, 'unknown error') + "'")
+
+class pulse():
+	def __init__(self, gpio_on, gpio_off, delay):
+		self.gpio_on = gpio_on
+		self.gpio_off = gpio_off
+		self.delay = delay
+
+def mergePulses(existing, added):
+	# Interleave added pulses into an existing waveform by time, as pigpio's wave_add_generic does
+	events = OrderedDict()
+	for pulses in (existing, added):
+		t = 0
+		for p in pulses:
+			on, off = events.get(t, (0, 0))
+			events[t] = (on | p.gpio_on, off | p.gpio_off)
+			t += p.delay
+		events.setdefault(t, (0, 0))
+	times = sorted(events)
+	return [pulse(events[t][0], events[t][1], times[ii+1] - t) for ii, t in enumerate(times[:-1])] + \
+		([pulse(events[times[-1]][0], events[times[-1]][1], 0)] if any(events[times[-1]]) else [])
+
+class Wave():
+	def __init__(self, pulses, cbs):
+		self.pulses = pulses
+		self.cbs = cbs
+		self.micros = sum(p.delay for p in pulses)
+		self.edges = sum(bin(p.gpio_on).count('1') for p in pulses)
+
+class pi():
+	def __init__(self, host='localhost', port=8888, callLatency=0.0002):
+		self.connected = True
+		self.callLatency = callLatency
+		self.callCounts = OrderedDict()
+		self.lock = threading.Lock()
+		self.modes = {}
+		self.levels = {}
+		self.building = []
+		self.waves = {}
+		self.transmit = [] # (wave id, start time, end time) for the wave on air and the one synced behind it
+		self.wavesSent = 0
+		self.edgesSent = 0
+		self.idleGaps = 0 # sync sends that found the transmitter already idle after an earlier wave
+		self.scripts = {}
+
+	def call(self, name):
+		self.callCounts[name] = self.callCounts.get(name, 0) + 1
+		if self.callLatency:
+			time.sleep(self.callLatency)
+
+	def retire(self, now):
+		while self.transmit and self.transmit[0][2] <= now:
+			self.transmit.pop(0)
+
+	def checkGpio(self, gpio):
+		if not 0 <= gpio <= 53:
+			raiseError(PI_BAD_GPIO)
+
+	def stop(self):
+		self.connected = False
+
+	def set_mode(self, gpio, mode):
+		self.call('set_mode')
+		self.checkGpio(gpio)
+		if not 0 <= mode <= 7:
+			raiseError(PI_BAD_MODE)
+		self.modes[gpio] = mode
+		return 0
+
+	def get_mode(self, gpio):
+		self.call('get_mode')
+		self.checkGpio(gpio)
+		return self.modes.get(gpio, INPUT)
+
+	def write(self, gpio, level):
+		self.call('write')
+		self.checkGpio(gpio)
+		if level not in (0, 1):
+			raiseError(PI_BAD_LEVEL)
+		self.levels[gpio] = level
+		return 0
+
+	def read(self, gpio):
+		self.call('read')
+		self.checkGpio(gpio)
+		return self.levels.get(gpio, 0)
+
+	def set_bank_1(self, bits):
+		self.call('set_bank_1')
+		for gpio in range(32):
+			if bits & 1<<gpio:
+				self.levels[gpio] = 1
+		return 0
+
+	def clear_bank_1(self, bits):
+		self.call('clear_bank_1')
+		for gpio in range(32):
+			if bits & 1<<gpio:
+				self.levels[gpio] = 0
+		return 0
+
+	def store_script(self, script):
+		# Only the w (write) command is simulated, arguments may be p0-p9 parameters
+		self.call('store_script')
+		if isinstance(script, bytes):
+			script = script.decode()
+		tokens = script.split()
+		if len(tokens) % 3 or any(cmd != 'w' for cmd in tokens[0::3]):
+			raiseError(PI_BAD_SCRIPT)
+		free = [sid for sid in range(MAX_SCRIPTS) if sid not in self.scripts]
+		if not free:
+			raiseError(PI_BAD_SCRIPT)
+		self.scripts[free[0]] = [tuple(tokens[ii+1:ii+3]) for ii in range(0, len(tokens), 3)]
+		return free[0]
+
+	def script_status(self, script_id):
+		self.call('script_status')
+		if script_id not in self.scripts:
+			raiseError(PI_BAD_SCRIPT_ID)
+		return PI_SCRIPT_HALTED, [0]*10
+
+	def run_script(self, script_id, params=None):
+		# Runs to completion before returning, pigpiod runs scripts in a thread of their own
+		self.call('run_script')
+		if script_id not in self.scripts:
+			raiseError(PI_BAD_SCRIPT_ID)
+		params = list(params or []) + [0]*10
+		value = lambda arg: params[int(arg[1:])] if arg.startswith('p') else int(arg)
+		for gpio, level in self.scripts[script_id]:
+			self.levels[value(gpio)] = value(level)
+		return 0
+
+	def delete_script(self, script_id):
+		self.call('delete_script')
+		if self.scripts.pop(script_id, None) is None:
+			raiseError(PI_BAD_SCRIPT_ID)
+		return 0
+
+	def wave_get_max_pulses(self):
+		self.call('wave_get_max_pulses')
+		return MAX_PULSES
+
+	def wave_get_max_cbs(self):
+		self.call('wave_get_max_cbs')
+		return MAX_CBS
+
+	def wave_clear(self):
+		self.call('wave_clear')
+		with self.lock:
+			self.building = []
+			self.waves = {}
+		return 0
+
+	def wave_add_new(self):
+		self.call('wave_add_new')
+		self.building = []
+		return 0
+
+	def wave_add_generic(self, pulses):
+		self.call('wave_add_generic')
+		if not pulses:
+			return 0
+		for p in pulses:
+			struct.pack('III', p.gpio_on, p.gpio_off, p.delay) # struct.error for values pigpio cannot send
+		merged = mergePulses(self.building, pulses) if self.building else list(pulses)
+		if len(merged) > MAX_PULSES:
+			raiseError(PI_TOO_MANY_PULSES)
+		self.building = merged
+		return len(merged)
+
+	def createWave(self, cbs):
+		if not self.building:
+			raiseError(PI_EMPTY_WAVEFORM)
+		with self.lock:
+			if sum(w.cbs for w in self.waves.values()) + cbs > MAX_CBS:
+				raiseError(PI_TOO_MANY_CBS)
+			free = [wid for wid in range(MAX_WAVES) if wid not in self.waves]
+			if not free:
+				raiseError(PI_NO_WAVEFORM_ID)
+			self.waves[free[0]] = Wave(self.building, cbs)
+			self.building = []
+		return free[0]
+
+	def wave_create(self):
+		self.call('wave_create')
+		return self.createWave(2*len(self.building) + 2) # a control block for each level change and delay
+
+	def wave_create_and_pad(self, percent):
+		self.call('wave_create_and_pad')
+		if 2*len(self.building) + 2 > MAX_CBS*percent//100:
+			raiseError(PI_TOO_MANY_CBS)
+		return self.createWave(MAX_CBS*percent//100)
+
+	def wave_delete(self, wave_id):
+		self.call('wave_delete')
+		with self.lock:
+			if wave_id not in self.waves:
+				raiseError(PI_BAD_WAVE_ID)
+			del self.waves[wave_id]
+		return 0
+
+	def wave_send_using_mode(self, wave_id, mode):
+		self.call('wave_send_using_mode')
+		if mode not in (WAVE_MODE_ONE_SHOT, WAVE_MODE_ONE_SHOT_SYNC):
+			raiseError(PI_BAD_WAVE_MODE) # repeating waves are not simulated
+		with self.lock:
+			wave = self.waves.get(wave_id)
+			if wave is None:
+				raiseError(PI_BAD_WAVE_ID)
+			now = time.time()
+			self.retire(now)
+			if mode == WAVE_MODE_ONE_SHOT:
+				self.transmit = []
+			elif not self.transmit and self.wavesSent:
+				self.idleGaps += 1
+			for wid, start, end in self.transmit[1:]: # a sync send replaces any wave already waiting to start
+				self.wavesSent -= 1
+				self.edgesSent -= self.waves[wid].edges if wid in self.waves else 0
+			self.transmit = self.transmit[:1]
+			start = self.transmit[0][2] if self.transmit else now
+			self.transmit.append((wave_id, start, start + wave.micros/1000000))
+			self.wavesSent += 1
+			self.edgesSent += wave.edges
+		return len(wave.pulses)
+
+	def wave_tx_at(self):
+		self.call('wave_tx_at')
+		with self.lock:
+			self.retire(time.time())
+			if not self.transmit:
+				return NO_TX_WAVE
+			if self.transmit[0][0] not in self.waves:
+				return WAVE_NOT_FOUND
+			return self.transmit[0][0]
+
+	def wave_tx_busy(self):
+		self.call('wave_tx_busy')
+		with self.lock:
+			self.retire(time.time())
+			return 1 if self.transmit else 0
+
+	def wave_tx_stop(self):
+		self.call('wave_tx_stop')
+		with self.lock:
+			self.transmit = []
+		return 0
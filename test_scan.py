@@ -0,0 +1,34 @@
+#!/usr/bin/python3
+
+# Scan planning checks against the simulated pigpio backend - python3 -m unittest test_scan
+
+import os
+import unittest
+os.environ['JWBCAM_PIGPIO'] = 'sim'
+import JWBCamPIGPIO as daemon
+
+
+class ScanTest(unittest.TestCase):
+	def test_frames_ascend(self):
+		scan = daemon.Scan({'frames':5, 'end':30000, 'pin':None}, 2000)
+		self.assertEqual(scan.positions[-1], 30000)
+		self.assertEqual(scan.steps, sorted(scan.steps))
+		self.assertGreater(scan.moveSteps, scan.steps[-1])
+	
+	def test_end_within_run_up(self):
+		lead = daemon.planRamp().accelFinished + 2
+		for end in (2000 + lead//2, 2000 + lead, 2000 - lead//2):
+			with self.assertRaises(ValueError):
+				daemon.Scan({'frames':5, 'end':end, 'pin':None}, 2000)
+	
+	def test_too_many_frames(self):
+		with self.assertRaises(ValueError):
+			daemon.Scan({'frames':100000000, 'end':2**60, 'pin':None}, 0)
+	
+	def test_too_long(self):
+		with self.assertRaises(ValueError):
+			daemon.Scan({'frames':5, 'end':2**60, 'pin':None}, 0)
+
+
+if __name__ == '__main__':
+	unittest.main()